@@ -3,10 +3,17 @@
 #   {users: [bob, etc], num_samples: [124, etc.],
 #   user_data: {bob : {x:[img1,img2,etc], y:[class1,class2,etc]}, etc}}
 # where 'img_' is a vectorized representation of the corresponding image
+#
+# The images are first converted by a pool of processes into binary shards of
+# MAX_WRITERS writers each, data/intermediate/uint8_shards/all_data_<i>.npz,
+# which hold the pixels as uint8; the .json files are then exported from the
+# shards, scaling the pixels to [0, 1] as they are loaded (see load_shard).
 
 from __future__ import division
+import argparse
 import json
 import math
+import multiprocessing
 import numpy as np
 import os
 import sys
@@ -20,6 +27,11 @@ sys.path.append(utils_dir)
 import util
 
 MAX_WRITERS = 100  # max number of writers per json file.
+IMAGE_SIZE = 28, 28  # original image size is 128, 128
+
+parent_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+shard_dir = os.path.join(parent_path, 'data', 'intermediate', 'uint8_shards')
+json_dir = os.path.join(parent_path, 'data', 'all_data')
 
 
 def relabel_class(c):
@@ -37,62 +49,105 @@ def relabel_class(c):
     else:
         return (int(c, 16) - 61)
 
-parent_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
-
-by_writer_dir = os.path.join(parent_path, 'data', 'intermediate', 'images_by_writer')
-writers = util.load_obj(by_writer_dir)
-
-num_json = int(math.ceil(len(writers) / MAX_WRITERS))
-
-users = []
-num_samples = []
-user_data = {}
-
-writer_count, all_writers = 0, 0
-json_index = 0
-for (w, l) in writers:
-
-    users.append(w)
-    num_samples.append(len(l))
-    user_data[w] = {'x': [], 'y': []}
 
-    size = 28, 28  # original image size is 128, 128
-    for (f, c) in l:
+def convert_writer(writer):
+    '''
+    returns (writer, pixels, classes) for a (writer, [list of (file, class)])
+    tuple, with the pixels of every image as a uint8 row
+    '''
+    w, l = writer
+    x = np.zeros((len(l), IMAGE_SIZE[0] * IMAGE_SIZE[1]), dtype=np.uint8)
+    y = np.zeros(len(l), dtype=np.int64)
+    for i, (f, c) in enumerate(l):
         file_path = os.path.join(parent_path, f)
         img = Image.open(file_path)
         gray = img.convert('L')
-        gray.thumbnail(size, Image.ANTIALIAS)
-        arr = np.asarray(gray).copy()
-        vec = arr.flatten()
-        vec = vec / 255  # scale all pixel values to between 0 and 1
-        vec = vec.tolist()
-
-        nc = relabel_class(c)
-
-        user_data[w]['x'].append(vec)
-        user_data[w]['y'].append(nc)
+        gray.thumbnail(IMAGE_SIZE, Image.ANTIALIAS)
+        x[i] = np.asarray(gray).flatten()
+        y[i] = relabel_class(c)
+    return w, x, y
 
-    writer_count += 1
-    all_writers += 1
-    
-    if writer_count == MAX_WRITERS or all_writers == len(writers):
 
-        all_data = {}
-        all_data['users'] = users
-        all_data['num_samples'] = num_samples
-        all_data['user_data'] = user_data
+def write_shard(shard_path, converted):
+    '''writes the (writer, pixels, classes) tuples of a batch of writers'''
+    np.savez(
+        shard_path,
+        users=np.array([w for w, _, _ in converted], dtype=str),
+        num_samples=np.array([len(y) for _, _, y in converted], dtype=np.int64),
+        x=np.concatenate([x for _, x, _ in converted]),
+        y=np.concatenate([y for _, _, y in converted]))
 
-        file_name = 'all_data_%d.json' % json_index
-        file_path = os.path.join(parent_path, 'data', 'all_data', file_name)
 
-        print('writing %s' % file_name)
-
-        with open(file_path, 'w') as outfile:
-            json.dump(all_data, outfile)
-
-        writer_count = 0
-        json_index += 1
-        
-        users[:] = []
-        num_samples[:] = []
-        user_data.clear()
+def load_shard(shard_path):
+    '''
+    returns the data of a shard as a dict of the same form as the json
+    files, with x and y as np arrays; pixel values are scaled to [0, 1]
+    '''
+    with np.load(shard_path) as shard:
+        users = shard['users'].tolist()
+        num_samples = shard['num_samples']
+        x = shard['x'] / 255  # scale all pixel values to between 0 and 1
+        y = shard['y']
+
+    bounds = np.concatenate([[0], np.cumsum(num_samples)])
+    user_data = {}
+    for i, w in enumerate(users):
+        user_data[w] = {'x': x[bounds[i]:bounds[i + 1]], 'y': y[bounds[i]:bounds[i + 1]]}
+    return {'users': users, 'num_samples': num_samples.tolist(), 'user_data': user_data}
+
+
+def export_json(json_index):
+    '''writes all_data_<json_index>.json from the corresponding shard'''
+    data = load_shard(os.path.join(shard_dir, 'all_data_%d.npz' % json_index))
+
+    all_data = {}
+    all_data['users'] = data['users']
+    all_data['num_samples'] = data['num_samples']
+    all_data['user_data'] = {
+        w: {'x': d['x'].tolist(), 'y': d['y'].tolist()} for w, d in data['user_data'].items()}
+
+    file_name = 'all_data_%d.json' % json_index
+    file_path = os.path.join(json_dir, file_name)
+
+    print('writing %s' % file_name)
+
+    with open(file_path, 'w') as outfile:
+        json.dump(all_data, outfile)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_workers',
+                    help='number of processes converting images and writing .json files; default: number of cpus;',
+                    type=int,
+                    default=os.cpu_count())
+    parser.add_argument('--no_json',
+                    help='only write the uint8 shards, without exporting them to .json files;',
+                    action='store_true')
+    args = parser.parse_args()
+
+    by_writer_dir = os.path.join(parent_path, 'data', 'intermediate', 'images_by_writer')
+    writers = util.load_obj(by_writer_dir)
+
+    num_json = int(math.ceil(len(writers) / MAX_WRITERS))
+
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+
+    with multiprocessing.Pool(args.num_workers) as pool:
+        # Writers are converted in order, and written as soon as their
+        # batch is complete
+        converted = pool.imap(convert_writer, writers, chunksize=4)
+        for json_index in range(num_json):
+            batch = writers[json_index * MAX_WRITERS:(json_index + 1) * MAX_WRITERS]
+            file_name = 'all_data_%d.npz' % json_index
+            print('writing %s' % file_name)
+            write_shard(os.path.join(shard_dir, file_name), [next(converted) for _ in batch])
+
+        if not args.no_json:
+            for _ in pool.imap_unordered(export_json, range(num_json)):
+                pass
+
+
+if __name__ == '__main__':
+    main()
@@ -24,24 +24,10 @@ if [ ! -f ../data/intermediate/class_file_dirs.pkl ]; then
   echo "finished extracting file directories of images"
 fi
 
-if [ ! -f ../data/intermediate/class_file_hashes.pkl ]; then
-  echo "------------------------------"
-  echo "calculating image hashes"
-  python3 get_hashes.py
-  echo "finished calculating image hashes"
-fi
-
-if [ ! -f ../data/intermediate/write_with_class.pkl ]; then
-  echo "------------------------------"
-  echo "assigning class labels to write images"
-  python3 match_hashes.py
-  echo "finished assigning class labels to write images"
-fi
-
 if [ ! -f ../data/intermediate/images_by_writer.pkl ]; then
   echo "------------------------------"
-  echo "grouping images by writer"
-  python3 group_by_writer.py
+  echo "hashing images, assigning class labels to write images and grouping them by writer"
+  python3 get_hashes.py
   echo "finished grouping images by writer"
 fi
 
@@ -1,4 +1,16 @@
+# Hashes the by_class and by_write images, matches every write image with the
+# class of the class image with the same hash, and groups the write images by
+# writer into data/intermediate/images_by_writer.pkl.
+#
+# Images are hashed by a pool of processes. Their digests are kept in
+# data/intermediate/file_digests.pkl, keyed by file and checked against the
+# file's size and modification time, so reruns only hash new or changed
+# files. The matched (writer, file, class) records are grouped as they are
+# hashed, without intermediate lists of hashes.
+
+import argparse
 import hashlib
+import multiprocessing
 import os
 import sys
 
@@ -8,46 +20,68 @@ sys.path.append(utils_dir)
 
 import util
 
-parent_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
-
-cfd = os.path.join(parent_path, 'data', 'intermediate', 'class_file_dirs')
-wfd = os.path.join(parent_path, 'data', 'intermediate', 'write_file_dirs')
-class_file_dirs = util.load_obj(cfd)
-write_file_dirs = util.load_obj(wfd)
-
-class_file_hashes = []
-write_file_hashes = []
-
-count = 0
-for tup in class_file_dirs:
-    if (count % 100000 == 0):
-        print('hashed %d class images' % count)
-
-    (cclass, cfile) = tup
-    file_path = os.path.join(parent_path, cfile)
-
-    chash = hashlib.md5(open(file_path, 'rb').read()).hexdigest()
-
-    class_file_hashes.append((cclass, cfile, chash))
+from group_by_writer import group_by_writer
+from match_hashes import class_hash_index, match_write_hashes
 
-    count += 1
-
-cfhd = os.path.join(parent_path, 'data', 'intermediate', 'class_file_hashes')
-util.save_obj(class_file_hashes, cfhd)
-
-count = 0
-for tup in write_file_dirs:
-    if (count % 100000 == 0):
-        print('hashed %d write images' % count)
-
-    (cclass, cfile) = tup
-    file_path = os.path.join(parent_path, cfile)
-
-    chash = hashlib.md5(open(file_path, 'rb').read()).hexdigest()
-
-    write_file_hashes.append((cclass, cfile, chash))
+parent_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 
-    count += 1
 
-wfhd = os.path.join(parent_path, 'data', 'intermediate', 'write_file_hashes')
-util.save_obj(write_file_hashes, wfhd)
+def file_digest(task):
+    '''
+    returns (size, mtime, md5 hex digest) of a (file path, cached entry)
+    task; the cached entry is returned if size and mtime did not change
+    '''
+    file_path, cached = task
+    stat = os.stat(file_path)
+    if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached
+    with open(file_path, 'rb') as f:
+        chash = hashlib.md5(f.read()).hexdigest()
+    return (stat.st_size, stat.st_mtime_ns, chash)
+
+
+def hash_files(file_dirs, pool, digests, new_digests, kind):
+    '''
+    yields (label, file dir, hash) for every (label, file dir) tuple, in
+    order; digests holds the cached entries, and the entries of the hashed
+    files are stored in new_digests
+    '''
+    tasks = ((os.path.join(parent_path, cfile), digests.get(cfile)) for (_, cfile) in file_dirs)
+    entries = pool.imap(file_digest, tasks, chunksize=256)
+    for count, ((label, cfile), entry) in enumerate(zip(file_dirs, entries)):
+        if (count % 100000 == 0):
+            print('hashed %d %s images' % (count, kind))
+        new_digests[cfile] = entry
+        yield (label, cfile, entry[2])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_workers',
+                    help='number of processes hashing images; default: number of cpus;',
+                    type=int,
+                    default=os.cpu_count())
+    args = parser.parse_args()
+
+    cfd = os.path.join(parent_path, 'data', 'intermediate', 'class_file_dirs')
+    wfd = os.path.join(parent_path, 'data', 'intermediate', 'write_file_dirs')
+    class_file_dirs = util.load_obj(cfd)
+    write_file_dirs = util.load_obj(wfd)
+
+    fdd = os.path.join(parent_path, 'data', 'intermediate', 'file_digests')
+    digests = util.load_obj(fdd) if os.path.isfile(fdd + '.pkl') else {}
+    new_digests = {}
+
+    with multiprocessing.Pool(args.num_workers) as pool:
+        class_hash_dict = class_hash_index(hash_files(class_file_dirs, pool, digests, new_digests, 'class'))
+        write_hashes = hash_files(write_file_dirs, pool, digests, new_digests, 'write')
+        writers = group_by_writer(match_write_hashes(write_hashes, class_hash_dict))
+
+    util.save_obj(new_digests, fdd)
+
+    ibwd = os.path.join(parent_path, 'data', 'intermediate', 'images_by_writer')
+    util.save_obj(writers, ibwd)
+
+
+if __name__ == '__main__':
+    main()
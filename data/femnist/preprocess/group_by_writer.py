@@ -9,19 +9,37 @@ import util
 
 parent_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 
-wwcd = os.path.join(parent_path, 'data', 'intermediate', 'write_with_class')
-write_class = util.load_obj(wwcd)
-
-writers = [] # each entry is a (writer, [list of (file, class)]) tuple
-cimages = []
-(cw, _, _) = write_class[0]
-for (w, f, c) in write_class:
-    if w != cw:
+
+def group_by_writer(write_class):
+    '''
+    returns a list of (writer, [list of (file, class)]) tuples, given an
+    iterable of (writer, file, class) tuples sorted by writer
+    '''
+    writers = [] # each entry is a (writer, [list of (file, class)]) tuple
+    cimages = []
+    cw = None
+    for (w, f, c) in write_class:
+        if cw is None:
+            cw = w
+        if w != cw:
+            writers.append((cw, cimages))
+            cw = w
+            cimages = [(f, c)]
+        cimages.append((f, c))
+    if cw is not None:
         writers.append((cw, cimages))
-        cw = w
-        cimages = [(f, c)]
-    cimages.append((f, c))
-writers.append((cw, cimages))
+    return writers
+
+
+def main():
+    wwcd = os.path.join(parent_path, 'data', 'intermediate', 'write_with_class')
+    write_class = util.load_obj(wwcd)
+
+    writers = group_by_writer(write_class)
+
+    ibwd = os.path.join(parent_path, 'data', 'intermediate', 'images_by_writer')
+    util.save_obj(writers, ibwd)
+
 
-ibwd = os.path.join(parent_path, 'data', 'intermediate', 'images_by_writer')
-util.save_obj(writers, ibwd)
+if __name__ == '__main__':
+    main()
@@ -9,20 +9,37 @@ import util
 
 parent_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 
-cfhd = os.path.join(parent_path, 'data', 'intermediate', 'class_file_hashes')
-wfhd = os.path.join(parent_path, 'data', 'intermediate', 'write_file_hashes')
-class_file_hashes = util.load_obj(cfhd) # each elem is (class, file dir, hash)
-write_file_hashes = util.load_obj(wfhd) # each elem is (writer, file dir, hash)
-
-class_hash_dict = {}
-for i in range(len(class_file_hashes)):
-    (c, f, h) = class_file_hashes[len(class_file_hashes)-i-1]
-    class_hash_dict[h] = (c, f)
-
-write_classes = []
-for tup in write_file_hashes:
-    (w, f, h) = tup
-    write_classes.append((w, f, class_hash_dict[h][0]))
-
-wwcd = os.path.join(parent_path, 'data', 'intermediate', 'write_with_class')
-util.save_obj(write_classes, wwcd)
+
+def class_hash_index(class_file_hashes):
+    '''
+    returns a dict mapping every hash to the (class, file dir) of the first
+    class image with that hash, given (class, file dir, hash) tuples
+    '''
+    class_hash_dict = {}
+    for (c, f, h) in class_file_hashes:
+        if h not in class_hash_dict:
+            class_hash_dict[h] = (c, f)
+    return class_hash_dict
+
+
+def match_write_hashes(write_file_hashes, class_hash_dict):
+    '''yields (writer, file dir, class) for every (writer, file dir, hash) tuple'''
+    for (w, f, h) in write_file_hashes:
+        yield (w, f, class_hash_dict[h][0])
+
+
+def main():
+    cfhd = os.path.join(parent_path, 'data', 'intermediate', 'class_file_hashes')
+    wfhd = os.path.join(parent_path, 'data', 'intermediate', 'write_file_hashes')
+    class_file_hashes = util.load_obj(cfhd) # each elem is (class, file dir, hash)
+    write_file_hashes = util.load_obj(wfhd) # each elem is (writer, file dir, hash)
+
+    class_hash_dict = class_hash_index(class_file_hashes)
+    write_classes = list(match_write_hashes(write_file_hashes, class_hash_dict))
+
+    wwcd = os.path.join(parent_path, 'data', 'intermediate', 'write_with_class')
+    util.save_obj(write_classes, wwcd)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,7 @@ import argparse
 import json
 import os
 import random
+import tempfile
 import time
 
 from collections import OrderedDict
@@ -144,30 +145,6 @@ if args.union:
     print("NAMES AND LISTS MATCH:", len(union_sample) == len(names))
     print("number of selected singles:", num_singles, "- total singles: ", len(singles))
 
-    union_data = dict([(name, {"x": [], "y": []}) for name in names])    
-    for f in files:
-        print("Looking for users in",f)
-        file_dir = os.path.join(subdir, f)
-        with open(file_dir, 'r') as inf:
-            data = json.load(inf, object_pairs_hook=OrderedDict)
-        for user, user_data in data['user_data'].items():
-            for name, union in zip(names,union_sample):
-                if user in union:
-                    union_data[name]['x'] += user_data['x']
-                    union_data[name]['y'] += user_data['y']
-
-        #print([(n,len(d["x"])) for n,d in union_data.items()])
-
-
-    # ------------
-    # create .json file
-
-    all_data = {}
-    all_data['users'] = names
-    all_data['num_samples'] = union_num_samples
-    all_data['unions'] = union_sample
-    all_data['user_data'] = union_data
-
     slabel = 'union'
 
     arg_frac = str(args.fraction)
@@ -178,12 +155,58 @@ if args.union:
     file_name = '%s_%s.json' % (slabel, arg_label)
     ouf_dir = os.path.join(data_dir, 'sampled_data', file_name)
 
-    # NOTE: For now, we just write everything to one big json. 
-    # This will give us issues if we use a large sample.
+    # Index of the unions of every user, so each user is routed to its
+    # unions with one lookup
+    union_index = {}
+    for name, union in zip(names, union_sample):
+        for user in union:
+            union_index.setdefault(user, []).append(name)
+
+    # Single pass over the data: the samples of every user are appended, as
+    # JSON text, to spill files of its union, one line per user and column,
+    # so only one input file is held in memory at a time
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(ouf_dir)) as spill_dir:
+        def spill_path(name, column):
+            return os.path.join(spill_dir, '%s.%s' % (name, column))
+
+        for f in files:
+            print("Looking for users in",f)
+            file_dir = os.path.join(subdir, f)
+            with open(file_dir, 'r') as inf:
+                data = json.load(inf, object_pairs_hook=OrderedDict)
+            fragments = OrderedDict()
+            for user, user_data in data['user_data'].items():
+                for name in union_index.get(user, []):
+                    for column in ['x', 'y']:
+                        fragment = json.dumps(user_data[column])[1:-1]
+                        if fragment:
+                            fragments.setdefault((name, column), []).append(fragment)
+            del data
+            for (name, column), lines in fragments.items():
+                with open(spill_path(name, column), 'a') as spill:
+                    spill.write('\n'.join(lines) + '\n')
+
+        # ------------
+        # create .json file, one union at a time; the output is the same
+        # as json.dump of the whole dict
 
-    print('writing %s' % file_name)
-    with open(ouf_dir, 'w') as outfile:
-        json.dump(all_data, outfile)
+        print('writing %s' % file_name)
+        with open(ouf_dir, 'w') as outfile:
+            outfile.write('{"users": %s, "num_samples": %s, "unions": %s, "user_data": {' % (
+                json.dumps(names), json.dumps(union_num_samples), json.dumps(union_sample)))
+            for i, name in enumerate(names):
+                if i > 0:
+                    outfile.write(', ')
+                outfile.write('%s: {' % json.dumps(name))
+                for j, column in enumerate(['x', 'y']):
+                    outfile.write('%s"%s": [' % (', ' if j > 0 else '', column))
+                    if os.path.exists(spill_path(name, column)):
+                        with open(spill_path(name, column), 'r') as spill:
+                            for k, line in enumerate(spill):
+                                outfile.write((', ' if k > 0 else '') + line.rstrip('\n'))
+                    outfile.write(']')
+                outfile.write('}')
+            outfile.write('}}')
 
 if not args.union:
     new_user_count = 0 # for iid case
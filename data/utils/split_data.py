@@ -4,74 +4,230 @@ splits data into train and test sets
 
 import argparse
 import json
+import multiprocessing
 import os
 import random
 import time
 import sys
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from operator import itemgetter
+
+import numpy as np
 
 from constants import DATASETS, SEED_FILES
 
-def create_jsons_for(user_files, which_set, max_users, include_hierarchy):
-    '''used in split-by-user case'''
-    user_count = 0
-    json_index = 0
-    users = []
+def write_user_shard(which_set, json_index, entries, include_hierarchy):
+    '''used in split-by-user case;
+    writes the json_index-th file of which_set, holding the users in
+    entries, a list of (user, hierarchy, num_samples, file name, user data)
+    tuples; the file is named after the source file of the last user
+    '''
+    all_data = {}
+    all_data['users'] = [u for u, _, _, _, _ in entries]
     if include_hierarchy:
-        hierarchies = []
+        all_data['hierarchies'] = [h for _, h, _, _, _ in entries]
+    all_data['num_samples'] = [ns for _, _, ns, _, _ in entries]
+    all_data['user_data'] = {u: ud for u, _, _, _, ud in entries}
+
+    f = entries[-1][3]
+    data_i = f.find('data')
+    num_i = data_i + 5
+    num_to_end = f[num_i:]
+    param_i = num_to_end.find('_')
+    param_to_end = '.json'
+    if param_i != -1:
+        param_to_end = num_to_end[param_i:]
+    nf = '%s_%d%s' % (f[:(num_i-1)], json_index, param_to_end)
+    file_name = '%s_%s_%s.json' % ((nf[:-5]), which_set, arg_label)
+    ouf_dir = os.path.join(dir, which_set, file_name)
+
+    print('writing %s' % file_name)
+    with open(ouf_dir, 'w') as outfile:
+        json.dump(all_data, outfile)
+
+
+def split_user_file(task):
+    '''used in split-by-user case;
+    loads one source file and writes the shards made only of its users;
+    returns the users of the other shards, keyed by (set, shard index), to
+    be written once the users of the neighbouring files are loaded
+    '''
+    f, set_users, max_users = task
+    file_dir = os.path.join(subdir, f)
+    with open(file_dir, 'r') as inf:
+        data = json.load(inf)
+
+    pieces = {}
+    for which_set, (start, user_files, num_set_users, include_hierarchy) in set_users.items():
+        shards = OrderedDict()
+        for pos, (u, h, ns, _) in enumerate(user_files, start):
+            shards.setdefault(pos // max_users, []).append((u, h, ns, f, data['user_data'][u]))
+        for json_index, entries in shards.items():
+            shard_size = min((json_index + 1) * max_users, num_set_users) - json_index * max_users
+            if len(entries) == shard_size:
+                write_user_shard(which_set, json_index, entries, include_hierarchy)
+            else:
+                pieces[(which_set, json_index)] = entries
+    return pieces
+
+
+def create_jsons_for(set_user_files, max_users, include_hierarchy, num_workers):
+    '''used in split-by-user case;
+    writes the users of every set, e.g. {'train': [...], 'test': [...]}, in
+    files of max_users users, in order; every source file is loaded once,
+    by one of num_workers processes
+    '''
+    # Users of a set are grouped by source file, in the order of files
+    tasks = OrderedDict((f, {}) for f in files)
+    for which_set, user_files in set_user_files.items():
+        if not include_hierarchy:
+            user_files = [(u, None, ns, f) for (u, ns, f) in user_files]
+        for pos, t in enumerate(user_files):
+            f = t[3]
+            if which_set not in tasks[f]:
+                tasks[f][which_set] = (pos, [], len(user_files), include_hierarchy)
+            tasks[f][which_set][1].append(t)
+    tasks = [(f, set_users, max_users) for f, set_users in tasks.items() if set_users]
+
+    def write_shards(results):
+        pending = {}
+        for pieces in results:
+            for (which_set, json_index), entries in pieces.items():
+                shard = pending.setdefault((which_set, json_index), [])
+                shard.extend(entries)
+                num_set_users = len(set_user_files[which_set])
+                if len(shard) == min((json_index + 1) * max_users, num_set_users) - json_index * max_users:
+                    write_user_shard(which_set, json_index, pending.pop((which_set, json_index)), include_hierarchy)
+
+    if num_workers <= 1 or len(tasks) <= 1:
+        write_shards(map(split_user_file, tasks))
     else:
-        hierarchies = None
-    num_samples = []
-    user_data = {}
-    for (i, t) in enumerate(user_files):
-        if include_hierarchy:
-            (u, h, ns, f) = t
-        else:
-            (u, ns, f) = t
+        # Forked, since this script runs at import time
+        with multiprocessing.get_context('fork').Pool(num_workers) as pool:
+            write_shards(pool.imap(split_user_file, tasks))
+
+
+def draw_sample_split(num_samples):
+    '''used in split-by-sample case;
+    returns (train_indices, test_indices, num_test_samples) for a user with
+    num_samples samples, or None if the user is dropped; the indices are
+    sorted np arrays, drawn from rng exactly as the per-sample loop did
+    '''
+    if num_samples < 2:
+        return None
+    # ensures number of train and test samples both >= 1
+    num_train_samples = max(1, int(args.frac * num_samples))
+    if num_samples == 2:
+        num_train_samples = 1
+
+    if args.name in ['shakespeare']:
+        train_indices = np.arange(num_train_samples)
+        test_indices = np.arange(num_train_samples + 80 - 1, num_samples)
+    else:
+        train_indices = np.sort(np.array(rng.sample(range(num_samples), num_train_samples), dtype=np.int64))
+        test_mask = np.ones(num_samples, dtype=bool)
+        test_mask[train_indices] = False
+        test_indices = np.flatnonzero(test_mask)
+
+    if len(train_indices) == 0 or len(test_indices) == 0:
+        return None
+    return train_indices, test_indices, num_samples - num_train_samples
+
+
+def gather(values, indices):
+    '''returns the list of values at the given indices'''
+    if len(indices) == 1:
+        return [values[indices[0]]]
+    return list(itemgetter(*indices.tolist())(values)) if len(indices) > 0 else []
+
+
+def load_sample_file(f):
+    file_dir = os.path.join(subdir, f)
+    with open(file_dir, 'r') as inf:
+        # Load data into an OrderedDict, to prevent ordering changes
+        # and enable reproducibility
+        data = json.load(inf, object_pairs_hook=OrderedDict)
+
+    print(data.keys())
+    return data
+
+
+def sample_lengths(data):
+    return [len(data['user_data'][u]['y']) for u in data['users']]
+
+
+def write_sample_split(f, data, splits):
+    '''used in split-by-sample case;
+    writes the train and test files of f, given the split of every user of
+    data, as returned by draw_sample_split
+    '''
+    num_samples_train = []
+    user_data_train = {}
+    num_samples_test = []
+    user_data_test = {}
+
+    user_indices = [] # indices of users in data['users'] that are not deleted
+
+    for i, (u, split) in enumerate(zip(data['users'], splits)):
+        if split is None:
+            continue
+        train_indices, test_indices, num_test_samples = split
+        user_indices.append(i)
+        num_samples_train.append(len(train_indices))
+        num_samples_test.append(num_test_samples)
+
+        cdata = data['user_data'][u]
+        user_data_train[u] = {'x': gather(cdata['x'], train_indices), 'y': gather(cdata['y'], train_indices)}
+        user_data_test[u] = {'x': gather(cdata['x'], test_indices), 'y': gather(cdata['y'], test_indices)}
+
+    users = [data['users'][i] for i in user_indices]
+
+    all_data_train = {}
+    all_data_train['users'] = users
+    all_data_train['num_samples'] = num_samples_train
+    all_data_train['user_data'] = user_data_train
+
+    all_data_test = {}
+    all_data_test['users'] = users
+    all_data_test['num_samples'] = num_samples_test
+    all_data_test['user_data'] = user_data_test 
+
+    if include_hierarchy:
+        hierarchies = [data['hierarchies'][i] for i in user_indices] 
+        all_data_train['hierarchies'] = hierarchies
+        all_data_test['hierarchies'] = hierarchies
+
+    if "unions" in data.keys():
+        unions = [data['unions'][i] for i in user_indices] 
+        all_data_train['unions'] = unions
+        all_data_test['unions'] = unions
+    else:
+        print("SOMETHING IS WRONG! ABORT! NO UNIONS IN DATA")
+
+    file_name_train = '%s_train_%s.json' % ((f[:-5]), arg_label)
+    file_name_test = '%s_test_%s.json' % ((f[:-5]), arg_label)
+    ouf_dir_train = os.path.join(dir, 'train', file_name_train)
+    ouf_dir_test = os.path.join(dir, 'test', file_name_test)
+    print('writing %s' % file_name_train)
+    with open(ouf_dir_train, 'w') as outfile:
+        json.dump(all_data_train, outfile)
+    print('writing %s' % file_name_test)
+    with open(ouf_dir_test, 'w') as outfile:
+        json.dump(all_data_test, outfile)
+
+
+def sample_split_worker(conn, f):
+    '''used in split-by-sample case;
+    loads f, sends the number of samples of its users, and writes the split
+    it receives back
+    '''
+    data = load_sample_file(f)
+    conn.send(sample_lengths(data))
+    write_sample_split(f, data, conn.recv())
+    conn.send(None)
+    conn.close()
 
-        file_dir = os.path.join(subdir, f)
-        with open(file_dir, 'r') as inf:
-            data = json.load(inf)
-        
-        users.append(u)
-        if include_hierarchy:
-            hierarchies.append(h)
-        num_samples.append(ns)
-        user_data[u] = data['user_data'][u]
-        user_count += 1
-
-        if (user_count == max_users) or (i == len(user_files) - 1):
-
-            all_data = {}
-            all_data['users'] = users
-            if include_hierarchy:
-                all_data['hierarchies'] = hierarchies
-            all_data['num_samples'] = num_samples
-            all_data['user_data'] = user_data
-
-            data_i = f.find('data')
-            num_i = data_i + 5
-            num_to_end = f[num_i:]
-            param_i = num_to_end.find('_')
-            param_to_end = '.json'
-            if param_i != -1:
-                param_to_end = num_to_end[param_i:]
-            nf = '%s_%d%s' % (f[:(num_i-1)], json_index, param_to_end)
-            file_name = '%s_%s_%s.json' % ((nf[:-5]), which_set, arg_label)
-            ouf_dir = os.path.join(dir, which_set, file_name)
-
-            print('writing %s' % file_name)
-            with open(ouf_dir, 'w') as outfile:
-                json.dump(all_data, outfile)
-
-            user_count = 0
-            json_index += 1
-            users = []
-            if include_hierarchy:
-                hierarchies = []
-            num_samples = []
-            user_data = {}
 
 parser = argparse.ArgumentParser()
 
@@ -94,6 +250,13 @@ parser.add_argument('--seed',
                 help='seed for random partitioning of test/train data',
                 type=int,
                 default=None)
+parser.add_argument('--num_workers',
+                help=('number of files split concurrently, each one held in '
+                      'memory by its own process, so that peak memory grows '
+                      'with it up to num_workers times that of a file; '
+                      'default: 1;'),
+                type=int,
+                default=1)
 
 parser.set_defaults(user=False)
 
@@ -177,102 +340,58 @@ if (args.user):
     max_users = sys.maxsize
     if args.name == 'femnist':
         max_users = 50 # max number of users per json file
-    create_jsons_for(train_user_files, 'train', max_users, include_hierarchy)
-    create_jsons_for(test_user_files, 'test', max_users, include_hierarchy)
+    create_jsons_for({'train': train_user_files, 'test': test_user_files}, max_users, include_hierarchy,
+                     args.num_workers)
 
 else:
     print('splitting data by sample')
 
-    for f in files:
-        file_dir = os.path.join(subdir, f)
-        with open(file_dir, 'r') as inf:
-            # Load data into an OrderedDict, to prevent ordering changes
-            # and enable reproducibility
-            data = json.load(inf, object_pairs_hook=OrderedDict)
-
-        print(data.keys())
-
-        num_samples_train = []
-        user_data_train = {}
-        num_samples_test = []
-        user_data_test = {}
-
-        user_indices = [] # indices of users in data['users'] that are not deleted
-
-        removed = 0
-        for i, u in enumerate(data['users']):
-
-            curr_num_samples = len(data['user_data'][u]['y'])
-            if curr_num_samples >= 2:
-                # ensures number of train and test samples both >= 1
-                num_train_samples = max(1, int(args.frac * curr_num_samples))
-                if curr_num_samples == 2:
-                    num_train_samples = 1
-
-                num_test_samples = curr_num_samples - num_train_samples
-
-                indices = [j for j in range(curr_num_samples)]
-                if args.name in ['shakespeare']:
-                    train_indices = [i for i in range(num_train_samples)]
-                    test_indices = [i for i in range(num_train_samples + 80 - 1, curr_num_samples)]
-                else:
-                    train_indices = rng.sample(indices, num_train_samples)                    
-                    test_indices = [i for i in range(curr_num_samples) if i not in train_indices]
-                
-                if len(train_indices) >= 1 and len(test_indices) >= 1:
-                    user_indices.append(i)
-                    num_samples_train.append(num_train_samples)
-                    num_samples_test.append(num_test_samples)
-                    user_data_train[u] = {'x': [], 'y': []}
-                    user_data_test[u] = {'x': [], 'y': []}
-
-                    train_blist = [False for _ in range(curr_num_samples)]
-                    test_blist = [False for _ in range(curr_num_samples)]
-                    
-                    for j in train_indices:
-                        train_blist[j] = True
-                    for j in test_indices:
-                        test_blist[j] = True
-
-                    for j in range(curr_num_samples):
-                        if (train_blist[j]):
-                            user_data_train[u]['x'].append(data['user_data'][u]['x'][j])
-                            user_data_train[u]['y'].append(data['user_data'][u]['y'][j])
-                        elif (test_blist[j]):
-                            user_data_test[u]['x'].append(data['user_data'][u]['x'][j])
-                            user_data_test[u]['y'].append(data['user_data'][u]['y'][j])
-
-        users = [data['users'][i] for i in user_indices]
-
-        all_data_train = {}
-        all_data_train['users'] = users
-        all_data_train['num_samples'] = num_samples_train
-        all_data_train['user_data'] = user_data_train
-
-        all_data_test = {}
-        all_data_test['users'] = users
-        all_data_test['num_samples'] = num_samples_test
-        all_data_test['user_data'] = user_data_test 
-
-        if include_hierarchy:
-            hierarchies = [data['hierarchies'][i] for i in user_indices] 
-            all_data_train['hierarchies'] = hierarchies
-            all_data_test['hierarchies'] = hierarchies
-
-        if "unions" in data.keys():
-            unions = [data['unions'][i] for i in user_indices] 
-            all_data_train['unions'] = unions
-            all_data_test['unions'] = unions
-        else:
-            print("SOMETHING IS WRONG! ABORT! NO UNIONS IN DATA")
-
-        file_name_train = '%s_train_%s.json' % ((f[:-5]), arg_label)
-        file_name_test = '%s_test_%s.json' % ((f[:-5]), arg_label)
-        ouf_dir_train = os.path.join(dir, 'train', file_name_train)
-        ouf_dir_test = os.path.join(dir, 'test', file_name_test)
-        print('writing %s' % file_name_train)
-        with open(ouf_dir_train, 'w') as outfile:
-            json.dump(all_data_train, outfile)
-        print('writing %s' % file_name_test)
-        with open(ouf_dir_test, 'w') as outfile:
-            json.dump(all_data_test, outfile)
+    # The splits of all the files are drawn here, in order, from the
+    # number of samples of their users, so that rng is used as in a serial
+    # run. Loading, gathering and writing the files is done by up to
+    # num_workers forked processes, since this script runs at import time.
+    if args.num_workers <= 1 or len(files) <= 1:
+        for f in files:
+            data = load_sample_file(f)
+            write_sample_split(f, data, [draw_sample_split(n) for n in sample_lengths(data)])
+    else:
+        ctx = multiprocessing.get_context('fork')
+
+        def start_worker(f):
+            parent_conn, child_conn = ctx.Pipe()
+            # Daemonic, so that the other workers are terminated if one fails
+            worker = ctx.Process(target=sample_split_worker, args=(child_conn, f), daemon=True)
+            worker.start()
+            child_conn.close()
+            return worker, parent_conn
+
+        def finish_worker(k):
+            worker, conn = workers.pop(k)
+            try:
+                conn.recv()
+            except EOFError:
+                sys.exit('splitting %s failed' % files[k])
+            worker.join()
+            conn.close()
+
+        # Each worker gets its split as soon as it has sent its lengths, and
+        # writes it while the next files are served; finished workers are
+        # only waited for to keep at most num_workers processes alive.
+        workers = {}
+        writing = deque()
+        num_started = 0
+        for k, f in enumerate(files):
+            while num_started < min(k + args.num_workers, len(files)):
+                if len(workers) == args.num_workers:
+                    finish_worker(writing.popleft())
+                workers[num_started] = start_worker(files[num_started])
+                num_started += 1
+            worker, conn = workers[k]
+            try:
+                conn.send([draw_sample_split(n) for n in conn.recv()])
+            except EOFError:
+                sys.exit('splitting %s failed' % f)
+            writing.append(k)
+
+        for k in writing:
+            finish_worker(k)
@@ -0,0 +1,49 @@
+"""Aggregation of the client updates received by the server."""
+
+import numpy as np
+
+
+class StreamingAggregator:
+    """Computes the weighted average of client updates as they arrive.
+
+    Updates are flat parameter vectors, as returned by
+    Model.get_flat_params. Every update is folded into a single
+    preallocated float64 buffer, so only one copy of the model is kept
+    regardless of the number of clients in the round. Updates are added in
+    the order they are received, which gives the same result as summing a
+    buffered list of updates in that order.
+    """
+
+    def __init__(self, num_params):
+        """Creates an aggregator for models with num_params scalars."""
+        self._acc = np.zeros(num_params, dtype=np.float64)
+        self._scratch = np.empty(num_params, dtype=np.float64)
+        self.total_weight = 0.
+        self.num_updates = 0
+
+    def add(self, num_samples, update):
+        """Folds a client update, weighted by num_samples, into the average.
+
+        Args:
+            num_samples: number of samples the client trained on.
+            update: flat np.ndarray with the client's weights.
+        """
+        np.multiply(num_samples, update, out=self._scratch, dtype=np.float64)
+        np.add(self._acc, self._scratch, out=self._acc)
+        self.total_weight += num_samples
+        self.num_updates += 1
+
+    def result(self):
+        """Returns the average of the updates added since the last reset.
+
+        Return:
+            flat float32 np.ndarray, laid out like the updates.
+        """
+        averaged = np.empty(self._acc.shape, dtype=np.float32)
+        np.divide(self._acc, self.total_weight, out=averaged, casting='unsafe')
+        return averaged
+
+    def reset(self):
+        self._acc.fill(0.)
+        self.total_weight = 0.
+        self.num_updates = 0
@@ -0,0 +1,130 @@
+"""Benchmarks the server-side aggregation of client updates.
+
+Compares the former buffered aggregation (every update kept until the end
+of the round, then averaged) with StreamingAggregator, reporting the time
+and the peak memory allocated per round. Updates are random arrays shaped
+like the variables of the chosen model, so TensorFlow is not needed.
+
+Run from the models directory:
+    python benchmarks/bench_aggregation.py --model reddit --clients-per-round 35
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+models_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(models_dir)
+
+from aggregator import StreamingAggregator
+
+
+# Variable shapes of the models, as created by their create_model.
+MODEL_SHAPES = {
+    # reddit.stacked_lstm: 10k vocabulary, 256 hidden units, 2 layers
+    'reddit': [(10000, 256), (512, 1024), (1024,), (512, 1024), (1024,), (256, 10000), (10000,)],
+    # femnist.cnn: 62 classes
+    'femnist': [(5, 5, 1, 32), (32,), (5, 5, 32, 64), (64,), (3136, 2048), (2048,), (2048, 62), (62,)],
+}
+
+
+def make_updates(shapes, num_clients, seed, flat=False):
+    """Yields (num_samples, update) tuples like the ones produced by the clients.
+
+    Every update is a fresh copy of one of a few random templates, so that
+    generating them costs little time. Updates are lists of per-variable
+    arrays, as returned by Model.get_params, or flat vectors, as returned by
+    Model.get_flat_params, if flat is set.
+    """
+    rng = np.random.RandomState(seed)
+    templates = [[rng.standard_normal(s).astype(np.float32) for s in shapes] for _ in range(2)]
+    if flat:
+        templates = [np.concatenate([v.ravel() for v in t]) for t in templates]
+    for i in range(num_clients):
+        template = templates[i % len(templates)]
+        yield rng.randint(1, 500), template.copy() if flat else [v.copy() for v in template]
+
+
+def buffered_round(shapes, num_clients, seed):
+    """Former Server.train_model + Server.update_model."""
+    updates = []
+    for num_samples, update in make_updates(shapes, num_clients, seed):
+        updates.append((num_samples, update))
+
+    total_weight = 0.
+    base = [0] * len(updates[0][1])
+    for (client_samples, client_model) in updates:
+        total_weight += client_samples
+        for i, v in enumerate(client_model):
+            base[i] += (client_samples * v.astype(np.float64))
+    return [v / total_weight for v in base]
+
+
+def streaming_round(shapes, num_clients, seed, aggregator):
+    for num_samples, update in make_updates(shapes, num_clients, seed, flat=True):
+        aggregator.add(num_samples, update)
+    averaged = aggregator.result()
+    aggregator.reset()
+    return averaged
+
+
+def measure(fn, num_rounds):
+    """Returns the mean seconds and the max peak bytes allocated per round.
+
+    The peak includes the random update templates, two copies of the model.
+    """
+    times, peaks = [], []
+    for r in range(num_rounds):
+        tracemalloc.start()
+        start = time.perf_counter()
+        fn(r)
+        times.append(time.perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return np.mean(times), max(peaks)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model',
+                    help='model whose variables are aggregated;',
+                    choices=sorted(MODEL_SHAPES),
+                    default='reddit')
+    parser.add_argument('--clients-per-round',
+                    help='number of client updates per round;',
+                    type=int,
+                    default=35)
+    parser.add_argument('--num-rounds',
+                    help='number of rounds to time;',
+                    type=int,
+                    default=3)
+    args = parser.parse_args()
+
+    shapes = MODEL_SHAPES[args.model]
+    aggregator = StreamingAggregator(sum(int(np.prod(s)) for s in shapes))
+
+    # Both paths produce the same float32 weights once loaded into the model.
+    expected = buffered_round(shapes, args.clients_per_round, 0)
+    expected = np.concatenate([v.ravel() for v in expected]).astype(np.float32)
+    actual = streaming_round(shapes, args.clients_per_round, 0, aggregator)
+    assert np.array_equal(expected, actual)
+
+    results = {
+        'buffered': measure(lambda r: buffered_round(shapes, args.clients_per_round, r), args.num_rounds),
+        'streaming': measure(
+            lambda r: streaming_round(shapes, args.clients_per_round, r, aggregator), args.num_rounds),
+    }
+
+    model_mb = sum(int(np.prod(s)) for s in shapes) * 4 / 2**20
+    print('model: %s (%.1f MB of float32), %d clients per round'
+          % (args.model, model_mb, args.clients_per_round))
+    for name, (seconds, peak) in results.items():
+        print('%-10s %8.3f s/round %10.1f MB peak' % (name, seconds, peak / 2**20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+"""End-to-end benchmarks of the federated simulation.
+
+Runs small configurations of the simulation through the same components as
+main.py (read_data, Client, Server, Model and the metrics writers) for a
+fixed number of rounds, and reports for each of them:
+    data_load_cold_s: seconds to read the train and test data the first
+        time, which builds their binary cache.
+    data_load_warm_s: seconds to read them again, from the cache.
+    round_s: mean seconds per training round (selection, local training
+        and aggregation).
+    rounds_per_s: training rounds per second.
+    eval_s: seconds to evaluate the model on the train and test data of
+        every client.
+    metrics_write_s: seconds to write the evaluation metrics of every round.
+    peak_rss_mb: peak resident memory of the process.
+
+The synthetic configuration generates its data in a temporary directory.
+The other ones copy the first users of the data under data/<dataset>/data,
+as produced by the dataset's preprocess.sh, into a temporary directory, so
+that only those users are loaded, and are skipped if there is none. Every
+configuration runs in a fresh process, so that its peak memory is its own.
+
+No reference results are shipped, since they depend on the machine. Save
+the results of a run as JSON, e.g. before a change, and compare a later
+run on the same machine with them, which reports the metrics that got
+worse by more than a tolerance:
+    python benchmarks/bench_simulation.py --output base.json
+    python benchmarks/bench_simulation.py --baseline base.json
+
+Run from the models directory.
+"""
+
+import argparse
+import concurrent.futures
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+models_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(models_dir)
+
+from utils.profiler import peak_rss_mb
+
+
+# Small configurations of the simulation; num_users is the number of users
+# of the data that are kept.
+CONFIGS = {
+    'synthetic': {
+        'dataset': 'synthetic', 'model': 'log_reg', 'num_users': 200,
+        'num_rounds': 20, 'clients_per_round': 10, 'batch_size': 10},
+    'femnist': {
+        'dataset': 'femnist', 'model': 'cnn', 'num_users': 50,
+        'num_rounds': 5, 'clients_per_round': 5, 'batch_size': 10},
+    'shakespeare': {
+        'dataset': 'shakespeare', 'model': 'stacked_lstm', 'num_users': 20,
+        'num_rounds': 3, 'clients_per_round': 3, 'batch_size': 10},
+    'sent140': {
+        'dataset': 'sent140', 'model': 'stacked_lstm', 'num_users': 200,
+        'num_rounds': 5, 'clients_per_round': 10, 'batch_size': 10},
+    'reddit': {
+        'dataset': 'reddit', 'model': 'stacked_lstm', 'num_users': 50,
+        'num_rounds': 3, 'clients_per_round': 5, 'batch_size': 5},
+}
+
+# Metrics compared with the baseline, and whether higher values are better.
+COMPARED_METRICS = {
+    'data_load_cold_s': False,
+    'data_load_warm_s': False,
+    'round_s': False,
+    'rounds_per_s': True,
+    'eval_s': False,
+    'metrics_write_s': False,
+    'peak_rss_mb': False,
+}
+
+SYNTHETIC_NUM_CLASSES = 5
+SYNTHETIC_NUM_DIM = 60
+
+
+def generate_synthetic_data(data_dir, num_users, seed):
+    """Writes train and test JSON files of synthetic data into data_dir.
+
+    The users are generated as in data/synthetic/main.py, and their samples
+    are split 90/10 into train and test sets.
+    """
+    sys.path.append(os.path.join(models_dir, '..', 'data', 'synthetic'))
+    import data_generator
+
+    rng = np.random.RandomState(seed)
+    dataset = data_generator.SyntheticDataset(
+        num_classes=SYNTHETIC_NUM_CLASSES, prob_clusters=[1.0], num_dim=SYNTHETIC_NUM_DIM, seed=seed)
+    num_samples = np.minimum(rng.lognormal(3, 2, num_users).astype(int) + 5, 1000)
+
+    splits = {'train': {}, 'test': {}}
+    for i, n in enumerate(num_samples):
+        task = dataset.get_task(n)
+        num_train = max(1, int(0.9 * n))
+        splits['train'][str(i)] = {'x': task['x'][:num_train].tolist(), 'y': task['y'][:num_train].tolist()}
+        splits['test'][str(i)] = {'x': task['x'][num_train:].tolist(), 'y': task['y'][num_train:].tolist()}
+
+    for name, user_data in splits.items():
+        os.makedirs(os.path.join(data_dir, name))
+        users = list(user_data)
+        with open(os.path.join(data_dir, name, 'data.json'), 'w') as outf:
+            json.dump({
+                'users': users,
+                'num_samples': [len(user_data[u]['y']) for u in users],
+                'user_data': user_data,
+            }, outf)
+
+
+def copy_user_subset(src_dir, dst_dir, num_users):
+    """Copies the train and test data of the first num_users users of src_dir.
+
+    The users are the first ones of the train .json files in sorted order,
+    which are only read until enough users are found; the test files are
+    read until the test data of all of them is found. Each set is written
+    to a single data.json in dst_dir, with the users in the same order.
+    """
+    users, records = [], {'train': {}, 'test': {}}
+    for name in ('train', 'test'):
+        set_dir = os.path.join(src_dir, name)
+        for f in sorted(os.listdir(set_dir)):
+            if not f.endswith('.json'):
+                continue
+            with open(os.path.join(set_dir, f), 'r') as inf:
+                cdata = json.load(inf)
+            for i, u in enumerate(cdata['users']):
+                if name == 'train' and len(users) < num_users:
+                    users.append(u)
+                elif name == 'train' or u not in records['train']:
+                    continue
+                records[name][u] = (
+                    cdata['num_samples'][i],
+                    cdata['user_data'][u],
+                    cdata['hierarchies'][i] if 'hierarchies' in cdata else None,
+                    cdata['unions'][i] if 'unions' in cdata else None)
+            if len(records[name]) == len(users) and (name == 'test' or len(users) == num_users):
+                break
+
+    for name, user_records in records.items():
+        kept = [u for u in users if u in user_records]
+        subset = {
+            'users': kept,
+            'num_samples': [user_records[u][0] for u in kept],
+            'user_data': {u: user_records[u][1] for u in kept},
+        }
+        for i, key in ((2, 'hierarchies'), (3, 'unions')):
+            if kept and user_records[kept[0]][i] is not None:
+                subset[key] = [user_records[u][i] for u in kept]
+        os.makedirs(os.path.join(dst_dir, name))
+        with open(os.path.join(dst_dir, name, 'data.json'), 'w') as outf:
+            json.dump(subset, outf)
+
+
+def run_config(config, seed, use_cache):
+    """Runs the given configuration and returns its measurements.
+
+    Return:
+        dict with the measured metrics, or with a 'skipped' entry with the
+        reason the configuration could not run.
+    """
+    import tensorflow as tf
+
+    import metrics.writer as metrics_writer
+    from baseline_constants import MODEL_PARAMS
+    from main import create_clients
+    from server import Server
+    from utils.model_utils import read_data
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        data_dir = os.path.join(tmp_dir, 'data')
+        if config['dataset'] == 'synthetic':
+            generate_synthetic_data(data_dir, config['num_users'], seed)
+        else:
+            src_dir = os.path.join(models_dir, '..', 'data', config['dataset'], 'data')
+            if not all(os.path.isdir(os.path.join(src_dir, name)) for name in ('train', 'test')):
+                return {'skipped': 'no data in %s' % src_dir}
+            copy_user_subset(src_dir, data_dir, config['num_users'])
+        train_dir, test_dir = os.path.join(data_dir, 'train'), os.path.join(data_dir, 'test')
+
+        random.seed(1 + seed)
+        np.random.seed(12 + seed)
+        tf.set_random_seed(123 + seed)
+        tf.logging.set_verbosity(tf.logging.WARN)
+
+        model_path = '%s.%s' % (config['dataset'], config['model'])
+        ClientModel = getattr(importlib.import_module(model_path), 'ClientModel')
+        client_model = ClientModel(seed, *MODEL_PARAMS[model_path])
+        server = Server(client_model)
+
+        # The first read builds the cache of the copied data, the second one
+        # opens it
+        data_load_s = []
+        for _ in range(2):
+            start = time.perf_counter()
+            users, groups, unions, train_data, test_data = read_data(
+                train_dir, test_dir, use_cache, client_model.encode_user_data, client_model.data_cache_name,
+                client_model.data_cache_key())
+            data_load_s.append(time.perf_counter() - start)
+
+        clients = create_clients(users, groups, unions, train_data, test_data, client_model)
+
+        start = time.perf_counter()
+        for r in range(config['num_rounds']):
+            server.select_clients(r, clients, num_clients=config['clients_per_round'])
+            server.train_model(num_epochs=1, batch_size=config['batch_size'])
+            server.update_model()
+        rounds_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        eval_metrics = {s: server.test_model(clients, set_to_use=s) for s in ('train', 'test')}
+        eval_s = time.perf_counter() - start
+
+        ids, c_groups, c_num_samples, c_num_users = server.get_clients_info(clients)
+        writer = metrics_writer.MetricsWriter(tmp_dir, 'stat_metrics')
+        start = time.perf_counter()
+        for r in range(config['num_rounds']):
+            for partition, metrics in eval_metrics.items():
+                writer.write(r, ids, metrics, c_groups, c_num_samples, partition, c_num_users)
+            writer.flush()
+        writer.close()
+        metrics_write_s = time.perf_counter() - start
+
+        server.close_model()
+        return {
+            'num_clients': len(clients),
+            'data_load_cold_s': data_load_s[0],
+            'data_load_warm_s': data_load_s[1],
+            'round_s': rounds_s / config['num_rounds'],
+            'rounds_per_s': config['num_rounds'] / rounds_s,
+            'eval_s': eval_s,
+            'metrics_write_s': metrics_write_s,
+            'peak_rss_mb': peak_rss_mb(),
+        }
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def run_in_process(config, seed, use_cache):
+    """Runs the configuration in a new process, started from models_dir."""
+    ctx = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+        return executor.submit(run_config, config, seed, use_cache).result()
+
+
+def compare(results, baseline, tolerance):
+    """Prints the change of every metric with respect to the baseline.
+
+    Return:
+        list of (config, metric) pairs that got worse by more than tolerance,
+        a fraction of the baseline value.
+    """
+    regressions = []
+    print('%-12s %-16s %12s %12s %9s' % ('config', 'metric', 'baseline', 'current', 'change'))
+    for name in sorted(results['configs']):
+        current = results['results'].get(name, {})
+        previous = baseline['results'].get(name, {})
+        if 'skipped' in current or 'skipped' in previous or not previous:
+            continue
+        if baseline['configs'].get(name) != results['configs'][name]:
+            print('%-12s configuration differs from the baseline; not compared' % name)
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            if not previous.get(metric):
+                continue
+            change = current[metric] / previous[metric] - 1
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > tolerance:
+                regressions.append((name, metric))
+                flag = '  REGRESSION'
+            print('%-12s %-16s %12.4f %12.4f %+8.1f%%%s'
+                  % (name, metric, previous[metric], current[metric], 100 * change, flag))
+    return regressions
+
+
+def environment():
+    info = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+    }
+    try:
+        import tensorflow as tf
+        info['tensorflow'] = tf.__version__
+    except ImportError:
+        pass
+    return info
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--configs',
+                    help='configurations to run; default: all;',
+                    nargs='+',
+                    choices=sorted(CONFIGS),
+                    default=sorted(CONFIGS))
+    parser.add_argument('--seed',
+                    help='seed of the simulation and of the synthetic data;',
+                    type=int,
+                    default=0)
+    parser.add_argument('--no-data-cache',
+                    help='always parse the .json data files instead of using their binary cache;',
+                    dest='data_cache',
+                    action='store_false')
+    parser.add_argument('--output',
+                    help='path of the JSON file with the results;',
+                    type=str,
+                    default=None)
+    parser.add_argument('--baseline',
+                    help='JSON file with the results of a previous run to compare with;',
+                    type=str,
+                    default=None)
+    parser.add_argument('--tolerance',
+                    help='relative change above which a metric is reported as a regression;',
+                    type=float,
+                    default=0.1)
+    args = parser.parse_args()
+
+    # Model paths in main.py are relative to the models directory
+    os.chdir(models_dir)
+
+    results = {
+        'environment': environment(),
+        'seed': args.seed,
+        'data_cache': args.data_cache,
+        'configs': {name: CONFIGS[name] for name in args.configs},
+        'results': {},
+    }
+    for name in args.configs:
+        print('Running %s...' % name, flush=True)
+        result = run_in_process(CONFIGS[name], args.seed, args.data_cache)
+        results['results'][name] = result
+        if 'skipped' in result:
+            print('  skipped: %s' % result['skipped'])
+        else:
+            print('  ' + ', '.join('%s: %.4g' % (m, result[m]) for m in COMPARED_METRICS), flush=True)
+
+    if args.output:
+        with open(args.output, 'w') as outf:
+            json.dump(results, outf, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as inf:
+            baseline = json.load(inf)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('%d metrics got worse by more than %.0f%%' % (len(regressions), 100 * args.tolerance))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,22 @@
+import functools
 import numpy as np
-import os
 import tensorflow as tf
 
-from PIL import Image
-
+from celeba.image_cache import IMAGE_SIZE, load_image, open_image_cache
 from model import Model
 
 
-IMAGE_SIZE = 84
-IMAGES_DIR = os.path.join('..', 'data', 'celeba', 'data', 'raw', 'img_align_celeba')
-
-
 class ClientModel(Model):
+    # Number of decoded images kept in memory by an LRU cache instead of
+    # memory-mapping the whole image cache; 0 to use the image cache (built
+    # by celeba/image_cache.py) when available. Read on the first batch, so
+    # it can be set after creating the model (--celeba-image-lru-size).
+    image_lru_size = 0
+
     def __init__(self, seed, lr, num_classes):
         self.num_classes = num_classes
+        self._images, self._image_rows = None, None
+        self._load_image = None
         super(ClientModel, self).__init__(seed, lr)
 
     def create_model(self):
@@ -39,6 +42,12 @@ class ClientModel(Model):
         return input_ph, label_ph, minimize_op, eval_metric_ops, tf.math.reduce_mean(loss)
 
     def process_x(self, raw_x_batch):
+        if self._load_image is None:
+            self._open_images()
+        if self._images is not None:
+            rows = [self._image_rows.get(name, -1) for name in raw_x_batch]
+            if -1 not in rows:
+                return np.asarray(self._images[rows])
         x_batch = [self._load_image(i) for i in raw_x_batch]
         x_batch = np.array(x_batch)
         return x_batch
@@ -46,7 +55,9 @@ class ClientModel(Model):
     def process_y(self, raw_y_batch):
         return raw_y_batch
 
-    def _load_image(self, img_name):
-        img = Image.open(os.path.join(IMAGES_DIR, img_name))
-        img = img.resize((IMAGE_SIZE, IMAGE_SIZE)).convert('RGB')
-        return np.array(img)
+    def _open_images(self):
+        if self.image_lru_size > 0:
+            self._load_image = functools.lru_cache(maxsize=self.image_lru_size)(load_image)
+        else:
+            self._images, self._image_rows = open_image_cache()
+            self._load_image = load_image
@@ -0,0 +1,108 @@
+"""Decoded-image cache for the CelebA model.
+
+Decodes, once, every image referenced by the CelebA train/test/val data
+into a single memory-mapped uint8 array of shape (N, IMAGE_SIZE,
+IMAGE_SIZE, 3), stored with the list of the images' file names, whose
+position gives each image's row.
+
+Run from the models directory after preprocessing the CelebA data:
+    python celeba/image_cache.py
+"""
+
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+from PIL import Image
+
+
+IMAGE_SIZE = 84
+DATA_DIR = os.path.join('..', 'data', 'celeba', 'data')
+IMAGES_DIR = os.path.join(DATA_DIR, 'raw', 'img_align_celeba')
+CACHE_DIR = os.path.join(DATA_DIR, 'image_cache')
+IMAGES_FILE = 'images.npy'
+NAMES_FILE = 'names.json'
+
+
+def load_image(img_name, images_dir=IMAGES_DIR):
+    """Decodes the given image as a (IMAGE_SIZE, IMAGE_SIZE, 3) uint8 array."""
+    img = Image.open(os.path.join(images_dir, img_name))
+    img = img.resize((IMAGE_SIZE, IMAGE_SIZE)).convert('RGB')
+    return np.array(img)
+
+
+def referenced_images(data_dir=DATA_DIR):
+    """Returns the sorted names of the images used in the train/test/val data."""
+    names = set()
+    for subdir in ('train', 'test', 'val'):
+        subdir_path = os.path.join(data_dir, subdir)
+        if not os.path.isdir(subdir_path):
+            continue
+        for f in os.listdir(subdir_path):
+            if not f.endswith('.json'):
+                continue
+            with open(os.path.join(subdir_path, f), 'r') as inf:
+                cdata = json.load(inf)
+            for user_data in cdata['user_data'].values():
+                names.update(user_data['x'])
+    return sorted(names)
+
+
+def build_image_cache(names, cache_dir=CACHE_DIR, images_dir=IMAGES_DIR, num_workers=None):
+    """Decodes the given images into the cache, using a pool of processes."""
+    os.makedirs(cache_dir, exist_ok=True)
+    images_path = os.path.join(cache_dir, IMAGES_FILE)
+    names_path = os.path.join(cache_dir, NAMES_FILE)
+    if os.path.isfile(names_path):
+        os.remove(names_path)
+
+    images = np.lib.format.open_memmap(
+        images_path, mode='w+', dtype=np.uint8, shape=(len(names), IMAGE_SIZE, IMAGE_SIZE, 3))
+    with multiprocessing.Pool(num_workers) as pool:
+        decoded = pool.imap(functools.partial(load_image, images_dir=images_dir), names, chunksize=64)
+        for i, img in enumerate(decoded):
+            images[i] = img
+    images.flush()
+    del images
+
+    # The names are written last, so a half-written cache is never opened.
+    with open(names_path, 'w') as outf:
+        json.dump(names, outf)
+
+
+def open_image_cache(cache_dir=CACHE_DIR):
+    """Opens the image cache.
+
+    Return:
+        images: memory-mapped uint8 np.ndarray with one image per row.
+        rows: dict with image names as keys and their rows as values.
+        Both are None if the cache has not been built.
+    """
+    names_path = os.path.join(cache_dir, NAMES_FILE)
+    if not os.path.isfile(names_path):
+        return None, None
+    with open(names_path, 'r') as inf:
+        names = json.load(inf)
+    images = np.load(os.path.join(cache_dir, IMAGES_FILE), mmap_mode='r')
+    return images, {name: i for i, name in enumerate(names)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-workers',
+                    help='number of decoding processes; default: number of cpus;',
+                    type=int,
+                    default=None)
+    args = parser.parse_args()
+
+    names = referenced_images()
+    print('Decoding %d images into %s' % (len(names), CACHE_DIR))
+    build_image_cache(names, num_workers=args.num_workers)
+
+
+if __name__ == '__main__':
+    main()
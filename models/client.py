@@ -1,8 +1,17 @@
 import random
 import warnings
 
+from utils.cache_utils import materialize, num_samples
+from utils.model_utils import take
+
 
 class Client:
+    """A simulated device with its train and eval data.
+
+    The data of a client may be lazy views into the memory-mapped data
+    cache; they are only loaded in memory while the client trains or is
+    tested, and the sample counts are read from the cache's index.
+    """
     
     def __init__(self, client_id, group=None, union_list=None, train_data={'x' : [],'y' : []}, eval_data={'x' : [],'y' : []}, model=None):
         self._model = model
@@ -26,24 +35,47 @@ class Client:
             update: set of weights
             update_size: number of bytes in update
         """
-        print("TRAINING: client: %s - samples: %d" % (self.id, len(self.train_data['y'])))
-        
-        if minibatch is None:
-            data = self.train_data
-            comp, update = self.model.train(data, num_epochs, batch_size)
-        else:
-            frac = min(1.0, minibatch)
-            num_data = max(1, int(frac*len(self.train_data["x"])))
-            xs, ys = zip(*random.sample(list(zip(self.train_data["x"], self.train_data["y"])), num_data))
-            data = {'x': xs, 'y': ys}
-
-            # Minibatch trains for only 1 epoch - multiple local epochs don't make sense!
-            num_epochs = 1
-            comp, update = self.model.train(data, num_epochs, num_data)
+        data, num_epochs, batch_size = self.prepare_training(num_epochs, batch_size, minibatch)
+        comp, update = self.model.train(data, num_epochs, batch_size)
 
         num_train_samples = len(data['y'])
         return comp, num_train_samples, update
 
+    def prepare_training(self, num_epochs=1, batch_size=10, minibatch=None):
+        """Picks the data and training schedule for the next call to train.
+
+        Sampling the minibatch here, rather than inside the model, keeps the
+        global random state consumed in client order even when the training
+        itself is carried out by another process.
+
+        Args:
+            num_epochs: Number of epochs to train.
+            batch_size: Size of training batches.
+            minibatch: fraction of client's data to apply minibatch sgd,
+                None to use FedAvg
+        Return:
+            data: dict of the form {'x': [list], 'y': [list]} to train on
+            num_epochs: number of epochs to train on data
+            batch_size: size of the training batches
+        """
+        print("TRAINING: client: %s - samples: %d" % (self.id, self.num_train_samples))
+
+        train_data = materialize(self.train_data)
+        if minibatch is None:
+            return train_data, num_epochs, batch_size
+
+        frac = min(1.0, minibatch)
+        num_data = max(1, int(frac*len(train_data["x"])))
+        # Same draws as sampling the zipped (x, y) pairs
+        indices = random.sample(range(len(train_data["x"])), num_data)
+        # Columns other than x and y are not per sample (e.g. the token
+        # sequences that the Reddit model's x index into) and are kept whole.
+        data = dict(train_data)
+        data.update({k: take(train_data[k], indices) for k in ('x', 'y')})
+
+        # Minibatch trains for only 1 epoch - multiple local epochs don't make sense!
+        return data, 1, num_data
+
     def test(self, set_to_use='test'):
         """Tests self.model on self.test_data.
         
@@ -52,12 +84,23 @@ class Client:
         Return:
             dict of metrics returned by the model.
         """
+        return self.model.test(materialize(self.get_data(set_to_use)))
+
+    def get_data(self, set_to_use='test'):
+        """Returns the client's data for the given set.
+
+        The data are returned as stored, possibly as a lazy view of the
+        data cache.
+
+        Args:
+            set_to_use. Set to return. Should be in ['train', 'test', 'val'].
+        Return:
+            dict of the form {'x': [list], 'y': [list]}.
+        """
         assert set_to_use in ['train', 'test', 'val']
         if set_to_use == 'train':
-            data = self.train_data
-        elif set_to_use == 'test' or set_to_use == 'val':
-            data = self.eval_data
-        return self.model.test(data)
+            return self.train_data
+        return self.eval_data
 
     @property
     def num_test_samples(self):
@@ -66,9 +109,7 @@ class Client:
         Return:
             int: Number of test samples for this client
         """
-        if self.eval_data is None:
-            return 0
-        return len(self.eval_data['y'])
+        return num_samples(self.eval_data)
 
     @property
     def num_train_samples(self):
@@ -77,9 +118,7 @@ class Client:
         Return:
             int: Number of train samples for this client
         """
-        if self.train_data is None:
-            return 0
-        return len(self.train_data['y'])
+        return num_samples(self.train_data)
 
     @property
     def num_samples(self):
@@ -88,15 +127,7 @@ class Client:
         Return:
             int: Number of samples for this client
         """
-        train_size = 0
-
-        if self.train_data is not None:
-            train_size = len(self.train_data['y'])
-
-        test_size = 0 
-        if self.eval_data is not  None:
-            test_size = len(self.eval_data['y'])
-        return train_size + test_size
+        return self.num_train_samples + self.num_test_samples
 
     @property
     def model(self):
@@ -45,10 +45,12 @@ class ClientModel(Model):
             loss=loss,
             global_step=tf.train.get_global_step())
         eval_metric_ops = tf.count_nonzero(tf.equal(labels, predictions["classes"]))
+        self.sample_correct = tf.equal(labels, predictions["classes"])
+        self.sample_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=labels, logits=logits)
         return features, labels, train_op, eval_metric_ops, loss
 
     def process_x(self, raw_x_batch):
-        return np.array(raw_x_batch)
+        return np.asarray(raw_x_batch)
 
     def process_y(self, raw_y_batch):
-        return np.array(raw_y_batch)
+        return np.asarray(raw_y_batch)
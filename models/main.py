@@ -1,5 +1,6 @@
 """Script to run the baselines."""
 import argparse
+import functools
 import importlib
 import numpy as np
 import os
@@ -13,9 +14,12 @@ from baseline_constants import MAIN_PARAMS, MODEL_PARAMS
 from client import Client
 from server import Server
 from model import ServerModel
+from parallel import AsyncEvaluator, ClientPool
 
 from utils.args import parse_args
+from utils.eval_utils import EvalPolicy
 from utils.model_utils import read_data
+from utils.profiler import NullProfiler, Profiler
 
 STAT_METRICS_PATH = 'metrics/stat_metrics.csv'
 SYS_METRICS_PATH = 'metrics/sys_metrics.csv'
@@ -56,21 +60,111 @@ def main():
     # Create client model, and share params with server model
     tf.reset_default_graph()
     client_model = ClientModel(args.seed, *model_params)
+    model_attrs = {'legacy_shuffle': args.legacy_shuffle}
+    if args.dataset == 'celeba':
+        model_attrs['image_lru_size'] = args.celeba_image_lru_size
+    for name, value in model_attrs.items():
+        setattr(client_model, name, value)
+
+    # Create worker processes with their own model replicas, if requested
+    client_pool = None
+    if args.client_workers > 0:
+        client_pool = ClientPool(args.client_workers, model_path, args.seed, model_params, model_attrs)
+
+    # Time the phases of every round, if requested
+    profiler = NullProfiler()
+    if args.profile:
+        profiler = Profiler(args.metrics_dir, '{}_{}'.format('timing', args.metrics_name))
+        client_model.profiler = profiler
 
     # Create server
-    server = Server(client_model)
+    server = Server(client_model, client_pool, profiler, args.graph_aggregation,
+                    seed=args.seed, legacy_sampling=args.legacy_sampling)
 
     # Create clients
-    clients = setup_clients(args.dataset, client_model, args.use_val_set)
+    clients = setup_clients(args.dataset, client_model, args.use_val_set, args.data_cache)
     client_ids, client_groups, client_num_samples, client_num_users = server.get_clients_info(clients)
     print('Clients in Total: %d' % len(clients))
     print('Maximum number of users in a client (largest union): %d' % max([c.num_users for c in clients]))
 
+    # Clients evaluated in each evaluation round
+    eval_set = 'test' if not args.use_val_set else 'val'
+    policy = EvalPolicy([c.num_test_samples for c in clients], args.eval_train_fraction, args.eval_fraction,
+                        args.eval_strata, args.seed)
+
+    # Evaluate in a separate process, if requested
+    evaluator = None
+    if args.async_eval:
+        evaluator = AsyncEvaluator(
+            model_path, args.seed, model_params, model_attrs,
+            functools.partial(setup_clients, args.dataset, use_val_set=args.use_val_set, use_cache=args.data_cache),
+            args.metrics_format, args.metrics_dir, args.metrics_name, eval_set)
+
     # Initial status
     print('--- Random Initialization ---', flush=True)
-    stat_writer_fn = get_stat_writer_function(client_ids, client_groups, client_num_samples, args)
-    sys_writer_fn = get_sys_writer_function(args)
-    print_stats(0, server, clients, client_num_samples, args, stat_writer_fn, args.use_val_set, client_num_users)
+    sys_writer = metrics_writer.get_metrics_writer(
+        args.metrics_format, args.metrics_dir, '{}_{}'.format('sys', args.metrics_name))
+    writers = [sys_writer]
+    stat_writer_fn = None
+    if evaluator is None:
+        stat_writer = metrics_writer.get_metrics_writer(
+            args.metrics_format, args.metrics_dir, '{}_{}'.format('stat', args.metrics_name))
+        summary_writer = metrics_writer.SummaryWriter(args.metrics_dir, '{}_{}'.format('summary', args.metrics_name))
+        writers += [stat_writer, summary_writer]
+        stat_writer_fn = get_stat_writer_function(
+            client_ids, client_groups, client_num_samples, [stat_writer, summary_writer], profiler)
+    sys_writer_fn = get_sys_writer_function(sys_writer, profiler)
+    weights = client_num_users if client_num_users else client_num_samples
+
+    pending_samples = {}
+
+    def evaluate(num_round, final=False):
+        """Evaluates the global model, or submits it to the evaluator.
+
+        Return:
+            list of (num_round, eval_metrics, eval_sample) tuples of the
+            finished evaluations.
+        """
+        samples = {s: policy.sample(s, num_round, final) for s in ('train', eval_set)}
+        if evaluator is None:
+            #Note: We use the number of users as the weight
+            metrics = print_stats(num_round, server, clients, client_num_samples, args, stat_writer_fn, args.use_val_set, client_num_users, samples)
+            return [(num_round, metrics, samples[eval_set])]
+        with profiler.phase('submit_eval'):
+            evaluator.submit(num_round, server.get_model_params(), {s: sample.indices for s, sample in samples.items()})
+            pending_samples[num_round] = samples
+        return []
+
+    def print_evaluations(results):
+        """Prints the evaluations finished by the evaluator.
+
+        Return:
+            list of (num_round, eval_metrics, eval_sample) tuples.
+        """
+        evaluated = []
+        for num_round, train_metrics, eval_metrics in results:
+            samples = pending_samples.pop(num_round)
+            print('--- Evaluation of round %d ---' % num_round)
+            print_metrics(train_metrics, weights, prefix='train_', clients=clients, sample=samples['train'],
+                          confidence=args.eval_confidence)
+            print_metrics(eval_metrics, weights, prefix='{}_'.format(eval_set), clients=clients,
+                          sample=samples[eval_set], confidence=args.eval_confidence)
+            evaluated.append((num_round, eval_metrics, samples[eval_set]))
+        return evaluated
+
+    def close_all():
+        """Waits for the pending evaluations and closes the metrics files."""
+        if evaluator is not None:
+            print_evaluations(evaluator.close())
+        for writer in writers:
+            writer.close()
+
+    profiler.start_round(0)
+    evaluate(0)
+    with profiler.phase('write_metrics'):
+        for writer in writers:
+            writer.flush()
+    profiler.end_round()
 
     # State for the early stopping target
     round_where_target_reached = None
@@ -79,6 +173,7 @@ def main():
     # Simulate training
     for i in range(num_rounds):
         print('--- Round %d of %d: Training %d Clients ---' % (i + 1, num_rounds, clients_per_round), flush=True)
+        profiler.start_round(i + 1)
 
         # Select clients to train this round
         server.select_clients(i, online(clients), num_clients=clients_per_round)
@@ -92,26 +187,41 @@ def main():
         server.update_model()
 
         # Test model
-        if (i + 1) % eval_every == 0 or (i + 1) == num_rounds:
-            #Note: We use the number of users as the weight
-            metrics = print_stats(i + 1, server, clients, client_num_samples, args, stat_writer_fn, args.use_val_set, client_num_users)
-            
-            if args.target_performance:
-                if round_where_target_reached: 
+        eval_round = (i + 1) % eval_every == 0 or (i + 1) == num_rounds
+        last_round = (i + 1) == num_rounds or (
+            round_where_target_reached is not None and (i+1 - round_where_target_reached) >= final_rounds)
+        evaluated = evaluate(i + 1, final=last_round) if eval_round else []
+        if evaluator is not None:
+            evaluated += print_evaluations(evaluator.poll())
+
+        if args.target_performance:
+            if round_where_target_reached:
+                if eval_round:
                     print(f"\t!!!!q Only {final_rounds - (i+1 - round_where_target_reached)} rounds left till we quit")
                     if (i+1 - round_where_target_reached) >= final_rounds:
                         print("Goodbye!")
+                        close_all()
+                        profiler.end_round()
+                        print_profile(profiler)
                         exit()
-                else:
-                    ordered_metric = [metrics[c][args.target_metric] for c in sorted(metrics)]
-                    ordered_weights = [client_num_users[c] for c in sorted(client_num_users)]
-                    performance = np.average(ordered_metric, weights=ordered_weights)
-
-                    print("Current Performance: %.2f - Target %.2f - Remaining: %.2f" % (performance, args.target_performance, args.target_performance - performance))
-                    if performance >= args.target_performance:
+            else:
+                for num_round, metrics, sample in evaluated:
+                    # The target is reached once the lower bound of the performance is above it
+                    performance, lower, upper = estimate_metric(
+                        metrics, client_num_users, clients, sample, args.target_metric, args.eval_confidence)
+
+                    print("Current Performance: %.2f [%.2f, %.2f] - Target %.2f - Remaining: %.2f" % (performance, lower, upper, args.target_performance, args.target_performance - lower))
+                    if lower >= args.target_performance:
                         print("Reached target performance, will run %d final rounds and then quit." % final_rounds)
-                        round_where_target_reached = i+1
-            
+                        round_where_target_reached = num_round
+                        break
+
+        # Round boundary: push this round's metrics to disk
+        with profiler.phase('write_metrics'):
+            for writer in writers:
+                writer.flush()
+        profiler.end_round()
+
     # Save server model
     ckpt_path = os.path.join('checkpoints', args.dataset)
     if not os.path.exists(ckpt_path):
@@ -119,8 +229,10 @@ def main():
     save_path = server.save_model(os.path.join(ckpt_path, '{}.ckpt'.format(args.model)))
     print('Model saved in path: %s' % save_path, flush=True)
 
-    # Close models
+    # Close models and metrics files, after the last evaluations
+    close_all()
     server.close_model()
+    print_profile(profiler)
 
 def online(clients):
     """We assume all users are always online."""
@@ -137,9 +249,13 @@ def create_clients(users, groups, unions, train_data, test_data, model):
     return clients
 
 
-def setup_clients(dataset, model=None, use_val_set=False):
+def setup_clients(dataset, model=None, use_val_set=False, use_cache=True):
     """Instantiates clients based on given train and test data directories.
 
+    The data are encoded with model.encode_user_data, if a model is given.
+    If use_cache is set, they are read from the binary cache of the data
+    directories, which is built the first time they are read.
+
     Return:
         all_clients: list of Client objects.
     """
@@ -147,58 +263,94 @@ def setup_clients(dataset, model=None, use_val_set=False):
     train_data_dir = os.path.join('..', 'data', dataset, 'data', 'train')
     test_data_dir = os.path.join('..', 'data', dataset, 'data', eval_set)
 
-    users, groups, unions, train_data, test_data = read_data(train_data_dir, test_data_dir)
+    encode_fn, cache_name, cache_key = None, 'raw', None
+    if model is not None:
+        encode_fn, cache_name, cache_key = model.encode_user_data, model.data_cache_name, model.data_cache_key()
+    users, groups, unions, train_data, test_data = read_data(
+        train_data_dir, test_data_dir, use_cache, encode_fn, cache_name, cache_key)
 
     clients = create_clients(users, groups, unions, train_data, test_data, model)
 
     return clients
 
 
-def get_stat_writer_function(ids, groups, num_samples, args):
+def get_stat_writer_function(ids, groups, num_samples, writers, profiler):
 
     def writer_fn(num_round, metrics, partition, num_users):
-        metrics_writer.print_metrics(
-                num_round, ids, metrics, groups, num_samples, partition, num_users, args.metrics_dir, '{}_{}'.format('stat',args.metrics_name)) #NOTE: You switched around the arguments in the file name so it matches the rest of the files
+        # Only the clients that were evaluated get a row
+        evaluated_ids = [c for c in ids if c in metrics]
+        with profiler.phase('write_metrics'):
+            for writer in writers:
+                writer.write(num_round, evaluated_ids, metrics, groups, num_samples, partition, num_users)
 
     return writer_fn
 
 
-def get_sys_writer_function(args):
+def get_sys_writer_function(writer, profiler):
 
     def writer_fn(num_round, ids, metrics, groups, num_samples, num_users):
-        metrics_writer.print_metrics(
-            num_round, ids, metrics, groups, num_samples, 'train', num_users, args.metrics_dir, '{}_{}'.format('sys',args.metrics_name)) #NOTE: You switched around the arguments in the file name so it matches the rest of the files
+        with profiler.phase('write_metrics'):
+            writer.write(num_round, ids, metrics, groups, num_samples, 'train', num_users)
 
     return writer_fn
 
 
 def print_stats(
-    num_round, server, clients, client_num_samples, args, writer, use_val_set, client_num_users):
+    num_round, server, clients, client_num_samples, args, writer, use_val_set, client_num_users, samples):
     
     weights = client_num_users if client_num_users else client_num_samples
 
-    train_stat_metrics = server.test_model(clients, set_to_use='train')
-    print_metrics(train_stat_metrics, weights, prefix='train_')
+    train_sample = samples['train']
+    train_stat_metrics = server.test_model([clients[i] for i in train_sample.indices], set_to_use='train')
+    print_metrics(train_stat_metrics, weights, prefix='train_', clients=clients, sample=train_sample,
+                  confidence=args.eval_confidence)
     writer(num_round, train_stat_metrics, 'train', client_num_users)
 
     eval_set = 'test' if not use_val_set else 'val'
-    test_stat_metrics = server.test_model(clients, set_to_use=eval_set)
-    print_metrics(test_stat_metrics, weights, prefix='{}_'.format(eval_set))
+    test_sample = samples[eval_set]
+    test_stat_metrics = server.test_model([clients[i] for i in test_sample.indices], set_to_use=eval_set)
+    print_metrics(test_stat_metrics, weights, prefix='{}_'.format(eval_set), clients=clients, sample=test_sample,
+                  confidence=args.eval_confidence)
     writer(num_round, test_stat_metrics, eval_set, client_num_users)
 
     return test_stat_metrics    
 
 
-def print_metrics(metrics, weights, prefix=''):
+def estimate_metric(metrics, weights, clients, sample, metric, confidence):
+    """Estimates the weighted mean of metric over all clients from a sample.
+
+    Return:
+        (estimate, lower bound, upper bound)
+    """
+    ids = [clients[i].id for i in sample.indices]
+    return sample.estimate([metrics[c][metric] for c in ids], [weights[c] for c in ids], confidence)
+
+
+def print_profile(profiler):
+    """Prints the time spent in each phase and closes the timing file."""
+    summary = profiler.summary()
+    if summary:
+        print('--- Profile ---')
+        print(summary, flush=True)
+    profiler.close()
+
+
+def print_metrics(metrics, weights, prefix='', clients=None, sample=None, confidence=0.95):
     """Prints weighted averages of the given metrics.
 
+    If the metrics are those of a sample of the clients, the estimated
+    average over all clients and its confidence interval are printed too.
+
     Args:
         metrics: dict with client ids as keys. Each entry is a dict
             with the metrics of that client.
         weights: dict with client ids as keys. Each entry is the weight
             for that client.
+        clients: list of all Client objects, indexed by the sample.
+        sample: ClientSample of the clients in metrics, if any.
+        confidence: coverage of the interval.
     """
-    ordered_weights = [weights[c] for c in sorted(weights)]
+    ordered_weights = [weights[c] for c in sorted(metrics)]
     metric_names = metrics_writer.get_metrics_names(metrics)
     to_ret = None
     for metric in metric_names:
@@ -209,6 +361,11 @@ def print_metrics(metrics, weights, prefix=''):
                  np.percentile(ordered_metric, 10),
                  np.percentile(ordered_metric, 50),
                  np.percentile(ordered_metric, 90)), flush=True)
+        if sample is not None and not sample.is_full:
+            estimate, lower, upper = estimate_metric(metrics, weights, clients, sample, metric, confidence)
+            print('%s: %g, %g%% confidence interval [%g, %g] (%d of %d clients)' \
+                  % (prefix + metric + '_estimate', estimate, 100 * confidence, lower, upper,
+                     len(sample.indices), sample.num_clients), flush=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,105 @@
+"""Per-round summaries of the clients' metrics.
+
+A summary has one row per round, set and metric, with the number of
+clients that reported the metric, its mean and standard deviation across
+clients, unweighted and weighted by the clients' number of samples, and
+its 10th, 50th and 90th percentiles.
+"""
+
+import numpy as np
+import os
+import sys
+
+models_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(models_dir)
+
+from baseline_constants import NUM_ROUND_KEY
+
+
+PERCENTILES = [10, 50, 90]
+
+SUMMARY_COLUMNS = [
+    NUM_ROUND_KEY, 'set', 'metric', 'num_clients', 'mean', 'std', 'weighted_mean', 'weighted_std'] + [
+    'p{}'.format(p) for p in PERCENTILES]
+
+
+def summarize(round_numbers, sets, weights, metrics):
+    """Computes the summary of the given per-client metrics.
+
+    Rows are grouped by round and set with np.unique and reduced with
+    np.bincount, so the cost does not depend on the number of groups. Clients
+    without a value for a metric are left out of that metric's statistics.
+    The unweighted std has one degree of freedom, as pandas' std; the
+    percentiles are interpolated linearly, as np.percentile does.
+
+    Args:
+        round_numbers: array with the round of every row.
+        sets: array with the set of every row.
+        weights: array with the weight of every row, e.g. its number of
+            samples.
+        metrics: dict with metric names as keys and arrays with the value of
+            every row as values.
+    Return:
+        dict with the SUMMARY_COLUMNS as keys and arrays with one value per
+        (round, set, metric) row, sorted by round, set and metric.
+    """
+    round_numbers = np.asarray(round_numbers, dtype=np.int64)
+    sets = np.asarray(sets, dtype=str)
+    weights = np.nan_to_num(np.asarray(weights, dtype=np.float64))
+    keys, groups = np.unique(np.rec.fromarrays([round_numbers, sets]), return_inverse=True)
+    num_groups = len(keys)
+
+    summaries = []
+    for metric in sorted(metrics):
+        values = np.asarray(metrics[metric], dtype=np.float64)
+        valid = ~np.isnan(values)
+        summary = _summarize_groups(groups[valid], num_groups, weights[valid], values[valid])
+        summary['metric'] = np.full(num_groups, metric, dtype=object)
+        summaries.append(summary)
+
+    # Rows ordered by group first, then by metric
+    order = np.arange(num_groups * len(summaries)).reshape(len(summaries), num_groups).T.ravel()
+    columns = {
+        NUM_ROUND_KEY: np.tile(keys['f0'], len(summaries))[order],
+        'set': np.tile(keys['f1'].astype(object), len(summaries))[order],
+    }
+    for name in SUMMARY_COLUMNS[2:]:
+        columns[name] = np.concatenate([s[name] for s in summaries])[order] if summaries else np.array([])
+    return columns
+
+
+def _summarize_groups(groups, num_groups, weights, values):
+    counts = np.bincount(groups, minlength=num_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.bincount(groups, values, num_groups) / counts
+        squares = np.bincount(groups, (values - mean[groups]) ** 2, num_groups)
+        std = np.sqrt(np.where(counts > 1, squares, np.nan) / (counts - 1))
+
+        total_weight = np.bincount(groups, weights, num_groups)
+        weighted_mean = np.bincount(groups, weights * values, num_groups) / total_weight
+        weighted_squares = np.bincount(groups, weights * (values - weighted_mean[groups]) ** 2, num_groups)
+        weighted_std = np.sqrt(weighted_squares / total_weight)
+
+    summary = {
+        'num_clients': counts,
+        'mean': mean,
+        'std': std,
+        'weighted_mean': weighted_mean,
+        'weighted_std': weighted_std,
+    }
+
+    # Percentiles: values sorted within each group, interpolated between
+    # the two closest ranks.
+    sorted_values = values[np.lexsort((values, groups))]
+    starts = np.cumsum(counts) - counts
+    non_empty = counts > 0
+    for p in PERCENTILES:
+        percentile = np.full(num_groups, np.nan)
+        rank = p / 100. * (counts[non_empty] - 1)
+        low = np.floor(rank).astype(np.int64)
+        high = np.minimum(low + 1, counts[non_empty] - 1)
+        low_values = sorted_values[starts[non_empty] + low]
+        high_values = sorted_values[starts[non_empty] + high]
+        percentile[non_empty] = low_values + (high_values - low_values) * (rank - low)
+        summary['p{}'.format(p)] = percentile
+    return summary
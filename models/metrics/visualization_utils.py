@@ -11,6 +11,12 @@ import sys
 
 from decimal import Decimal
 
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as pads
+except ImportError:
+    pa = None
+
 models_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(models_dir)
 
@@ -22,12 +28,31 @@ from baseline_constants import (
     LOCAL_COMPUTATIONS_KEY,
     NUM_ROUND_KEY,
     NUM_SAMPLES_KEY)
+from metrics.summary import SUMMARY_COLUMNS, summarize
+from metrics.writer import COLUMN_NAMES
+
+
+# Rows of the csv files read at a time when filtering rounds.
+CSV_CHUNK_SIZE = 1 << 18
+
 
+def load_data(stat_metrics_file='stat_metrics.csv', sys_metrics_file='sys_metrics.csv', rounds=None, columns=None):
+    """Loads the data from the given stat_metric and sys_metric files.
 
-def load_data(stat_metrics_file='stat_metrics.csv', sys_metrics_file='sys_metrics.csv'):
-    """Loads the data from the given stat_metric and sys_metric files."""
-    stat_metrics = pd.read_csv(stat_metrics_file) if stat_metrics_file else None
-    sys_metrics = pd.read_csv(sys_metrics_file) if sys_metrics_file else None
+    Files can be csv files or Parquet datasets, as written by writer.py with
+    --metrics-format parquet. Parquet datasets only read the requested rounds
+    and columns from disk.
+
+    Args:
+        stat_metrics_file: path of the statistical metrics, or None.
+        sys_metrics_file: path of the system metrics, or None.
+        rounds: (first_round, last_round) tuple with the inclusive range of
+            rounds to load; None loads every round.
+        columns: list of the columns to load; None loads every column. The
+            round number is always loaded.
+    """
+    stat_metrics = read_metrics(stat_metrics_file, rounds, columns) if stat_metrics_file else None
+    sys_metrics = read_metrics(sys_metrics_file, rounds, columns) if sys_metrics_file else None
 
     if stat_metrics is not None:
         stat_metrics.sort_values(by=NUM_ROUND_KEY, inplace=True)
@@ -37,6 +62,41 @@ def load_data(stat_metrics_file='stat_metrics.csv', sys_metrics_file='sys_metric
     return stat_metrics, sys_metrics
 
 
+def read_metrics(path, rounds=None, columns=None):
+    """Reads the given rounds and columns of a metrics file into a pd.DataFrame."""
+    if columns is not None and NUM_ROUND_KEY not in columns:
+        columns = [NUM_ROUND_KEY] + list(columns)
+    if os.path.isdir(path):
+        return _read_parquet_metrics(path, rounds, columns)
+
+    if rounds is None:
+        return pd.read_csv(path, usecols=columns)
+    chunks = pd.read_csv(path, usecols=columns, chunksize=CSV_CHUNK_SIZE)
+    return pd.concat(
+        [c[c[NUM_ROUND_KEY].between(rounds[0], rounds[1])] for c in chunks], ignore_index=True)
+
+
+def _read_parquet_metrics(path, rounds, columns):
+    if pa is None:
+        raise ImportError('Reading metrics in Parquet format requires pyarrow')
+    partitioning = pads.partitioning(
+        pa.schema([(NUM_ROUND_KEY, pa.int32()), ('set', pa.string())]), flavor='hive')
+    dataset = pads.dataset(path, format='parquet', partitioning=partitioning)
+    row_filter = None
+    if rounds is not None:
+        row_filter = (pads.field(NUM_ROUND_KEY) >= rounds[0]) & (pads.field(NUM_ROUND_KEY) <= rounds[1])
+    return dataset.to_table(columns=columns, filter=row_filter).to_pandas()
+
+
+def _as_dataframe(metrics, columns, rounds=None):
+    """Reads metrics if they are given as a path; otherwise selects rounds."""
+    if isinstance(metrics, str):
+        return read_metrics(metrics, rounds, columns)
+    if rounds is not None:
+        return metrics.loc[metrics[NUM_ROUND_KEY].between(rounds[0], rounds[1])]
+    return metrics
+
+
 def _set_plot_properties(properties):
     """Sets some plt properties."""
     if 'xlim' in properties:
@@ -50,40 +110,46 @@ def _set_plot_properties(properties):
 
 
 def plot_accuracy_vs_round_number(stat_metrics, weighted=False, plot_stds=False,
-        figsize=(10, 8), title_fontsize=16, **kwargs):
+        figsize=(10, 8), title_fontsize=16, rounds=None, summary=None, partition='test', **kwargs):
     """Plots the clients' average test accuracy vs. the round number.
 
+    The statistics are read from the summary written during the run; if it
+    is not given, they are computed from stat_metrics.
+
     Args:
-        stat_metrics: pd.DataFrame as written by writer.py.
+        stat_metrics: pd.DataFrame as written by writer.py, or the path of the
+            metrics, in which case only the columns needed are read. Not
+            used if summary is given.
         weighted: Whether the average across clients should be weighted by number of
             test samples.
         plot_stds: Whether to plot error bars corresponding to the std between users.
         figsize: Size of the plot as specified by plt.figure().
         title_fontsize: Font size for the plot's title.
+        rounds: (first_round, last_round) tuple with the inclusive range of rounds
+            to plot. If None, all rounds are plotted.
+        summary: pd.DataFrame as returned by load_summary, or None.
+        partition: Set whose accuracy is plotted, e.g. 'test' or 'train'.
         kwargs: Arguments to be passed to _set_plot_properties."""
+    if summary is None:
+        stat_metrics = _as_dataframe(stat_metrics, [NUM_ROUND_KEY, 'set', NUM_SAMPLES_KEY, ACCURACY_KEY], rounds)
+        summary = summarize_metrics(stat_metrics, [ACCURACY_KEY])
+    else:
+        summary = _as_dataframe(summary, None, rounds)
+    accuracies = summary.loc[(summary['metric'] == ACCURACY_KEY) & (summary['set'] == partition)]
+
     plt.figure(figsize=figsize)
     title_weighted = 'Weighted' if weighted else 'Unweighted'
     plt.title('Accuracy vs Round Number (%s)' % title_weighted, fontsize=title_fontsize)
-    if weighted:
-        accuracies = stat_metrics.groupby(NUM_ROUND_KEY).apply(_weighted_mean, ACCURACY_KEY, NUM_SAMPLES_KEY)
-        accuracies = accuracies.reset_index(name=ACCURACY_KEY)
-
-        stds = stat_metrics.groupby(NUM_ROUND_KEY).apply(_weighted_std, ACCURACY_KEY, NUM_SAMPLES_KEY)
-        stds = stds.reset_index(name=ACCURACY_KEY)
-    else:
-        accuracies = stat_metrics.groupby(NUM_ROUND_KEY, as_index=False).mean()
-        stds = stat_metrics.groupby(NUM_ROUND_KEY, as_index=False).std()
+    means = accuracies['weighted_mean' if weighted else 'mean']
+    stds = accuracies['weighted_std' if weighted else 'std']
 
     if plot_stds:
-        plt.errorbar(accuracies[NUM_ROUND_KEY], accuracies[ACCURACY_KEY], stds[ACCURACY_KEY])
+        plt.errorbar(accuracies[NUM_ROUND_KEY], means, stds)
     else:
-        plt.plot(accuracies[NUM_ROUND_KEY], accuracies[ACCURACY_KEY])
-
-    percentile_10 = stat_metrics.groupby(NUM_ROUND_KEY, as_index=False).quantile(0.1)
-    percentile_90 = stat_metrics.groupby(NUM_ROUND_KEY, as_index=False).quantile(0.9)
+        plt.plot(accuracies[NUM_ROUND_KEY], means)
 
-    plt.plot(percentile_10[NUM_ROUND_KEY], percentile_10[ACCURACY_KEY], linestyle=':')
-    plt.plot(percentile_90[NUM_ROUND_KEY], percentile_90[ACCURACY_KEY], linestyle=':')
+    plt.plot(accuracies[NUM_ROUND_KEY], accuracies['p10'], linestyle=':')
+    plt.plot(accuracies[NUM_ROUND_KEY], accuracies['p90'], linestyle=':')
 
     plt.legend(['Mean', '10th percentile', '90th percentile'], loc='upper left')
 
@@ -93,38 +159,64 @@ def plot_accuracy_vs_round_number(stat_metrics, weighted=False, plot_stds=False,
     plt.show()
 
 
-def _weighted_mean(df, metric_name, weight_name):
-    d = df[metric_name]
-    w = df[weight_name]
-    try:
-        return (w * d).sum() / w.sum()
-    except ZeroDivisionError:
-        return np.nan
+def load_summary(summary_file='summary_metrics.csv', rounds=None):
+    """Loads the per-round summary written during the run.
+
+    Args:
+        summary_file: path of the summary.
+        rounds: (first_round, last_round) tuple with the inclusive range of
+            rounds to load; None loads every round.
+    Return:
+        pd.DataFrame with the summary.SUMMARY_COLUMNS, or None if the file
+        does not exist.
+    """
+    if not summary_file or not os.path.isfile(summary_file):
+        return None
+    return read_metrics(summary_file, rounds)
+
 
+def summarize_metrics(stat_metrics, metric_names=None):
+    """Computes the per-round summary of the given per-client metrics.
 
-def _weighted_std(df, metric_name, weight_name):
-    d = df[metric_name]
-    w = df[weight_name]
-    try:
-        weigthed_mean = (w * d).sum() / w.sum()
-        return (w * ((d - weigthed_mean) ** 2)).sum() / w.sum()
-    except ZeroDivisionError:
-        return np.nan
+    Args:
+        stat_metrics: pd.DataFrame as written by writer.py.
+        metric_names: list of the metrics to summarize; None summarizes every
+            metric column.
+    Return:
+        pd.DataFrame like the one returned by load_summary.
+    """
+    if metric_names is None:
+        metric_names = [c for c in stat_metrics.columns if c not in COLUMN_NAMES]
+    summary = summarize(
+        stat_metrics[NUM_ROUND_KEY].to_numpy(),
+        stat_metrics['set'].astype(str).to_numpy(),
+        stat_metrics[NUM_SAMPLES_KEY].to_numpy(dtype=np.float64),
+        {m: stat_metrics[m].to_numpy(dtype=np.float64) for m in metric_names})
+    return pd.DataFrame(summary, columns=SUMMARY_COLUMNS)
 
 
 def plot_accuracy_vs_round_number_per_client(
-        stat_metrics, sys_metrics, max_num_clients, figsize=(15, 12), title_fontsize=16, max_name_len=10, **kwargs):
+        stat_metrics, sys_metrics, max_num_clients, figsize=(15, 12), title_fontsize=16, max_name_len=10,
+        rounds=None, **kwargs):
     """Plots the clients' test accuracy vs. the round number.
 
     Args:
-        stat_metrics: pd.DataFrame as written by writer.py.
-        sys_metrics: pd.DataFrame as written by writer.py. Allows us to know which client actually performed training
-            in each round. If None, then no indication is given of when was each client trained.
+        stat_metrics: pd.DataFrame as written by writer.py, or the path of the
+            metrics, in which case only the columns needed are read.
+        sys_metrics: pd.DataFrame as written by writer.py, or its path. Allows us to know which client actually
+            performed training in each round. If None, then no indication is given of when was each client trained.
         max_num_clients: Maximum number of clients to plot.
         figsize: Size of the plot as specified by plt.figure().
         title_fontsize: Font size for the plot's title.
         max_name_len: Maximum length for a client's id.
+        rounds: (first_round, last_round) tuple with the inclusive range of rounds
+            to plot. If None, all rounds are plotted.
         kwargs: Arguments to be passed to _set_plot_properties."""
+    stat_metrics = _as_dataframe(
+        stat_metrics, [CLIENT_ID_KEY, NUM_ROUND_KEY, NUM_SAMPLES_KEY, ACCURACY_KEY], rounds)
+    if sys_metrics is not None:
+        sys_metrics = _as_dataframe(sys_metrics, [CLIENT_ID_KEY, NUM_ROUND_KEY], rounds)
+
     # Plot accuracies per client.
     clients = stat_metrics[CLIENT_ID_KEY].unique()[:max_num_clients]
     cmap = plt.get_cmap('jet_r')
@@ -167,15 +259,20 @@ def plot_accuracy_vs_round_number_per_client(
     plt.show()
 
 
-def plot_bytes_written_and_read(sys_metrics, rolling_window=10, figsize=(10, 8), title_fontsize=16, **kwargs):
+def plot_bytes_written_and_read(
+        sys_metrics, rolling_window=10, figsize=(10, 8), title_fontsize=16, rounds=None, **kwargs):
     """Plots the cumulative sum of the bytes written and read by the server.
 
     Args:
-        sys_metrics: pd.DataFrame as written by writer.py.
+        sys_metrics: pd.DataFrame as written by writer.py, or the path of the
+            metrics, in which case only the columns needed are read.
         rolling_window: Number of previous rounds to consider in the cumulative sum.
         figsize: Size of the plot as specified by plt.figure().
         title_fontsize: Font size for the plot's title.
+        rounds: (first_round, last_round) tuple with the inclusive range of rounds
+            to plot. If None, all rounds are plotted.
         kwargs: Arguments to be passed to _set_plot_properties."""
+    sys_metrics = _as_dataframe(sys_metrics, [NUM_ROUND_KEY, BYTES_WRITTEN_KEY, BYTES_READ_KEY], rounds)
 
     plt.figure(figsize=figsize)
 
@@ -200,11 +297,13 @@ def plot_client_computations_vs_round_number(
         figsize=(25, 15),
         title_fontsize=16,
         max_name_len=10,
-        range_rounds=None):
+        range_rounds=None,
+        rounds=None):
     """Plots the clients' local computations against round number.
 
     Args:
-        sys_metrics: pd.DataFrame as written by writer.py.
+        sys_metrics: pd.DataFrame as written by writer.py, or the path of the
+            metrics, in which case only the columns needed are read.
         aggregate_window: Number of rounds that are aggregated. e.g. If set to 20, then
             rounds 0-19, 20-39, etc. will be added together.
         max_num_clients: Maximum number of clients to plot.
@@ -212,7 +311,11 @@ def plot_client_computations_vs_round_number(
         title_fontsize: Font size for the plot's title.
         max_name_len: Maximum length for a client's id.
         range_rounds: Tuple representing the range of rounds to be plotted. The rounds
-            are subsampled before aggregation. If None, all rounds are considered."""
+            are subsampled before aggregation. If None, all rounds are considered.
+        rounds: (first_round, last_round) tuple with the inclusive range of rounds
+            read from the metrics; the computations of the other rounds count
+            as 0. If None, all rounds are read."""
+    sys_metrics = _as_dataframe(sys_metrics, [CLIENT_ID_KEY, NUM_ROUND_KEY, LOCAL_COMPUTATIONS_KEY], rounds)
     plt.figure(figsize=figsize)
 
     num_rounds = sys_metrics[NUM_ROUND_KEY].max()
@@ -260,7 +363,7 @@ def plot_client_computations_vs_round_number(
     plt.show()
 
 
-def get_longest_flops_path(sys_metrics):
+def get_longest_flops_path(sys_metrics, rounds=None):
     """Prints the largest amount of flops required to complete training.
 
     To calculate this metric, we:
@@ -271,7 +374,11 @@ def get_longest_flops_path(sys_metrics):
     TODO: This metric would make more sense with seconds instead of FLOPS.
 
     Args:
-        sys_metrics: pd.DataFrame as written by writer.py."""
+        sys_metrics: pd.DataFrame as written by writer.py, or the path of the
+            metrics, in which case only the columns needed are read.
+        rounds: (first_round, last_round) tuple with the inclusive range of rounds
+            to consider. If None, all rounds are considered."""
+    sys_metrics = _as_dataframe(sys_metrics, [CLIENT_ID_KEY, NUM_ROUND_KEY, LOCAL_COMPUTATIONS_KEY], rounds)
     num_rounds = sys_metrics[NUM_ROUND_KEY].max()
     clients = sys_metrics[CLIENT_ID_KEY].unique()
 
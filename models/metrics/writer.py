@@ -1,19 +1,228 @@
-"""Writes the given metrics in a csv."""
+"""Writes the given metrics in a csv or a Parquet dataset."""
 
+import csv
 import numpy as np
 import os
-import pandas as pd
 import sys
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
 models_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(models_dir)
 
 from baseline_constants import CLIENT_ID_KEY, NUM_ROUND_KEY, NUM_SAMPLES_KEY
+from metrics.summary import SUMMARY_COLUMNS, summarize
 
 
 COLUMN_NAMES = [
     CLIENT_ID_KEY, NUM_ROUND_KEY, 'hierarchy', NUM_SAMPLES_KEY, 'set', 'num_users']
 
+# Bytes of rows buffered in memory between writes to the file.
+WRITE_BUFFER_SIZE = 1 << 20
+
+
+class MetricsWriter:
+    """Streams rows of metrics into a csv that is kept open during the run.
+
+    The resulting csv is of the form:
+        client_id, round_number, hierarchy, num_samples, set, num_users, metric1, metric2
+        twebbstack, 0, , 18, test, 1, 0.5, 0.89
+
+    Rows are written as they are received, through a buffered file, and
+    reach the disk when flush is called, e.g. at the end of every round. If
+    the file already exists, rows are appended to it without a header.
+    Missing values are written as empty fields, as pandas does.
+    """
+
+    def __init__(self, metrics_dir, metrics_name):
+        """
+        Args:
+            metrics_dir: String. Directory for the metrics file. May not exist.
+            metrics_name: String. Filename for the metrics file. May not exist.
+        """
+        self.metrics_dir = metrics_dir
+        self.path = os.path.join(metrics_dir, '{}.csv'.format(metrics_name))
+        self._file = None
+
+    def write(
+            self,
+            round_number,
+            client_ids,
+            metrics,
+            hierarchies,
+            num_samples,
+            partition,
+            num_users):
+        """Writes one row per client with the given metrics.
+
+        Args:
+            round_number: Number of the round the metrics correspond to.
+            client_ids: Ids of the clients. Not all ids must be in the following
+                dicts.
+            metrics: Dict keyed by client id. Each element is a dict of metrics
+                for that client in the specified round. The dicts for all clients
+                are expected to have the same set of keys.
+            hierarchies: Dict keyed by client id. Each element is a list of hierarchies
+                to which the client belongs.
+            num_samples: Dict keyed by client id. Each element is the number of test
+                samples for the client.
+            partition: String. Value of the 'set' column.
+            num_users: Dict keyed by client id. Each element is the number of
+                users in the client.
+        """
+        if self._file is None:
+            self._open()
+        columns = COLUMN_NAMES + get_metrics_names(metrics)
+        writer = csv.writer(self._file, lineterminator='\n')
+        if self._write_header:
+            writer.writerow(columns)
+            self._write_header = False
+
+        metric_names = columns[len(COLUMN_NAMES):]
+        for c_id in client_ids:
+            current_metrics = metrics.get(c_id, {})
+            writer.writerow([_format_value(v) for v in [
+                c_id,
+                round_number,
+                ','.join(hierarchies.get(c_id, [])),
+                num_samples.get(c_id, np.nan),
+                partition,
+                num_users.get(c_id, np.nan),
+            ] + [current_metrics.get(m, np.nan) for m in metric_names]])
+
+    def flush(self):
+        """Pushes the rows written so far to the file."""
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _open(self):
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        #NOTE: Only add headers if it's a new file
+        self._write_header = not os.path.isfile(self.path) or os.path.getsize(self.path) == 0
+        self._file = open(self.path, 'a', newline='', buffering=WRITE_BUFFER_SIZE)
+
+
+class SummaryWriter(MetricsWriter):
+    """Streams the per-round summary of the metrics into a csv.
+
+    Instead of one row per client, every call to write appends one row per
+    metric, with the statistics computed by metrics.summary.summarize,
+    weighting the clients by their number of samples.
+    """
+
+    def write(
+            self,
+            round_number,
+            client_ids,
+            metrics,
+            hierarchies,
+            num_samples,
+            partition,
+            num_users):
+        """Writes the summary of the given metrics.
+
+        Args are as in MetricsWriter.write.
+        """
+        if self._file is None:
+            self._open()
+        writer = csv.writer(self._file, lineterminator='\n')
+        if self._write_header:
+            writer.writerow(SUMMARY_COLUMNS)
+            self._write_header = False
+
+        client_ids = [c for c in client_ids if c in metrics]
+        summary = summarize(
+            [round_number] * len(client_ids),
+            [partition] * len(client_ids),
+            [num_samples.get(c, np.nan) for c in client_ids],
+            {m: [metrics[c].get(m, np.nan) for c in client_ids] for m in get_metrics_names(metrics)})
+        for row in zip(*[summary[name] for name in SUMMARY_COLUMNS]):
+            writer.writerow([_format_value(v) for v in row])
+
+
+class ParquetMetricsWriter:
+    """Writes metrics into a Parquet dataset partitioned by round and set.
+
+    The dataset is a directory, named after the metrics with a .parquet
+    extension, with one round_number=<round>/set=<set> subdirectory per
+    partition, as read by visualization_utils.load_data. Every call to
+    write stores one Parquet file with typed columns: the client ids are
+    dictionary encoded (categorical in pandas), the sample and user counts
+    are integers and the metrics are floats, with missing values as nulls.
+
+    Requires pyarrow.
+    """
+
+    def __init__(self, metrics_dir, metrics_name):
+        """
+        Args:
+            metrics_dir: String. Directory for the metrics dataset. May not exist.
+            metrics_name: String. Name of the metrics dataset. May not exist.
+        """
+        if pa is None:
+            raise ImportError('Writing metrics in Parquet format requires pyarrow')
+        self.path = os.path.join(metrics_dir, '{}.parquet'.format(metrics_name))
+
+    def write(
+            self,
+            round_number,
+            client_ids,
+            metrics,
+            hierarchies,
+            num_samples,
+            partition,
+            num_users):
+        """Writes one row per client with the given metrics.
+
+        Args are as in MetricsWriter.write.
+        """
+        client_ids = list(client_ids)
+        columns = {
+            CLIENT_ID_KEY: pa.array(client_ids, type=pa.string()).dictionary_encode(),
+            'hierarchy': pa.array([','.join(hierarchies.get(c, [])) for c in client_ids], type=pa.string()),
+            NUM_SAMPLES_KEY: pa.array([num_samples.get(c) for c in client_ids], type=pa.int64()),
+            'num_users': pa.array([num_users.get(c) for c in client_ids], type=pa.int64()),
+        }
+        for metric in get_metrics_names(metrics):
+            values = [metrics.get(c, {}).get(metric) for c in client_ids]
+            columns[metric] = pa.array(
+                [None if v is None or np.isnan(v) else float(v) for v in values], type=pa.float64())
+
+        partition_dir = os.path.join(
+            self.path, '{}={}'.format(NUM_ROUND_KEY, round_number), 'set={}'.format(partition))
+        os.makedirs(partition_dir, exist_ok=True)
+        part = len([f for f in os.listdir(partition_dir) if f.endswith('.parquet')])
+        pq.write_table(pa.table(columns), os.path.join(partition_dir, 'part-{}.parquet'.format(part)))
+
+    def flush(self):
+        """Every write is already a complete file."""
+        pass
+
+    def close(self):
+        pass
+
+
+def get_metrics_writer(metrics_format, metrics_dir, metrics_name):
+    """Returns a writer of metrics in the given format, 'csv' or 'parquet'."""
+    if metrics_format == 'parquet':
+        return ParquetMetricsWriter(metrics_dir, metrics_name)
+    return MetricsWriter(metrics_dir, metrics_name)
+
+
+def _format_value(value):
+    if isinstance(value, (float, np.floating)) and np.isnan(value):
+        return ''
+    return value
+
 
 def print_metrics(
         round_number,
@@ -27,56 +236,28 @@ def print_metrics(
         metrics_name):
     """Prints or appends the given metrics in a csv.
 
-    The resulting dataframe is of the form:
-        client_id, round_number, hierarchy, num_samples, metric1, metric2
-        twebbstack, 0, , 18, 0.5, 0.89
+    Opens the file, writes the rows as MetricsWriter.write does and closes
+    it; during a simulation, keep a MetricsWriter open instead.
 
     Args:
-        round_number: Number of the round the metrics correspond to. If
-            0, then the file in path is overwritten. If not 0, we append to
-            that file.
+        round_number: Number of the round the metrics correspond to.
         client_ids: Ids of the clients. Not all ids must be in the following
             dicts.
         metrics: Dict keyed by client id. Each element is a dict of metrics
-            for that client in the specified round. The dicts for all clients
-            are expected to have the same set of keys.
+            for that client in the specified round.
         hierarchies: Dict keyed by client id. Each element is a list of hierarchies
             to which the client belongs.
         num_samples: Dict keyed by client id. Each element is the number of test
             samples for the client.
         partition: String. Value of the 'set' column.
+        num_users: Dict keyed by client id. Each element is the number of
+            users in the client.
         metrics_dir: String. Directory for the metrics file. May not exist.
         metrics_name: String. Filename for the metrics file. May not exist.
     """
-    os.makedirs(metrics_dir, exist_ok=True)
-    path = os.path.join(metrics_dir, '{}.csv'.format(metrics_name))
-    
-    columns = COLUMN_NAMES + get_metrics_names(metrics)
-    client_data = pd.DataFrame(columns=columns)
-    for i, c_id in enumerate(client_ids):
-        current_client = {
-            'client_id': c_id,
-            'round_number': round_number,
-            'hierarchy': ','.join(hierarchies.get(c_id, [])),
-            'num_samples': num_samples.get(c_id, np.nan),
-            'set': partition,
-            'num_users': num_users.get(c_id, np.nan),
-        }
-
-        current_metrics = metrics.get(c_id, {})
-        for metric, metric_value in current_metrics.items():
-            current_client[metric] = metric_value
-        client_data.loc[len(client_data)] = current_client
-
-    print_dataframe(client_data, path)
-
-
-def print_dataframe(df, path):
-    """Writes the given dataframe in path as a csv"""
-    file_exists = os.path.isfile(path) #NOTE: Only add headers if it's a new file
-    mode = 'a' if file_exists else 'w'
-    header = mode == 'w'
-    df.to_csv(path, mode=mode, header=header, index=False)
+    writer = MetricsWriter(metrics_dir, metrics_name)
+    writer.write(round_number, client_ids, metrics, hierarchies, num_samples, partition, num_users)
+    writer.close()
 
 
 def get_metrics_names(metrics):
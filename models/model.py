@@ -1,6 +1,7 @@
 """Interfaces for ClientModel and ServerModel."""
 
 from abc import ABC, abstractmethod
+import itertools
 import numpy as np
 import os
 import sys
@@ -8,17 +9,40 @@ import tensorflow as tf
 
 from baseline_constants import ACCURACY_KEY
 
+from utils import cache_utils
 from utils.model_utils import batch_data
+from utils.profiler import NullProfiler
 from utils.tf_utils import graph_size
 
 
 class Model(ABC):
 
+    # Number of samples per session run in test_many.
+    eval_batch_size = 1024
+
+    # Whether batch_data shuffles with the global random state, as the
+    # published baselines did.
+    legacy_shuffle = False
+
+    # Name of the data cache holding the output of encode_user_data; models
+    # encoding their data differently must use different names.
+    data_cache_name = 'raw'
+
+    # Profiler timing the local training, replaced when profiling.
+    profiler = NullProfiler()
+
     def __init__(self, seed, lr, optimizer=None):
         self.lr = lr
         self.seed = seed
         self._optimizer = optimizer
 
+        # Per-sample evaluation tensors, optionally set by create_model.
+        self.sample_correct = None
+        self.sample_loss = None
+
+        # Global model variables, created by enable_graph_aggregation.
+        self._global_params = None
+
         self.graph = tf.Graph()
         with self.graph.as_default():
             tf.set_random_seed(123 + self.seed)
@@ -35,18 +59,139 @@ class Model(ABC):
             opts = tf.profiler.ProfileOptionBuilder.float_operation()
             self.flops = tf.profiler.profile(self.graph, run_meta=metadata, cmd='scope', options=opts).total_float_ops
 
+            self._create_flat_params_ops()
+
         np.random.seed(self.seed)
 
-    def set_params(self, model_params):
+    def _create_flat_params_ops(self):
+        """Creates the ops that read and write all trainable variables at once.
+
+        The trainable variables are laid out back to back in a single float32
+        vector; param_shapes and param_offsets describe where each of them
+        lives in it.
+        """
+        all_vars = tf.trainable_variables()
+        self.param_shapes = [tuple(v.shape.as_list()) for v in all_vars]
+        sizes = [int(np.prod(shape)) for shape in self.param_shapes]
+        self.param_offsets = np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+
+        self._flat_params = tf.concat(
+            [tf.reshape(tf.cast(v, tf.float32), [-1]) for v in all_vars], axis=0)
+        self._flat_params_ph = tf.placeholder(
+            tf.float32, shape=[self.num_params], name='flat_params')
+        parts = tf.split(self._flat_params_ph, sizes)
+        self._set_flat_params_op = tf.group(*[
+            tf.assign(v, tf.cast(tf.reshape(p, shape), v.dtype.base_dtype))
+            for v, p, shape in zip(all_vars, parts, self.param_shapes)])
+
+    def enable_graph_aggregation(self):
+        """Creates the variables and ops that average client models in the graph.
+
+        The global model is kept in a copy of the trainable variables,
+        initialized with their current values, and the weighted sum of the
+        trained client models in float64 accumulators, so the weights do not
+        leave the session during a round. The new variables are local and
+        not trainable, so they are neither trained nor saved.
+        """
+        if self._global_params is not None:
+            return
+
         with self.graph.as_default():
             all_vars = tf.trainable_variables()
-            for variable, value in zip(all_vars, model_params):
-                variable.load(value, self.sess)
+            local = [tf.GraphKeys.LOCAL_VARIABLES]
+            with tf.variable_scope('graph_aggregation'):
+                self._global_params = [
+                    tf.Variable(v.read_value(), trainable=False, collections=local, name='global_%d' % i)
+                    for i, v in enumerate(all_vars)]
+                accumulators = [
+                    tf.Variable(tf.zeros(v.shape, dtype=tf.float64), trainable=False, collections=local,
+                                name='accumulator_%d' % i)
+                    for i, v in enumerate(all_vars)]
+                total_weight = tf.Variable(
+                    tf.constant(0., dtype=tf.float64), trainable=False, collections=local, name='total_weight')
+
+            self._aggregation_weight_ph = tf.placeholder(tf.float64, shape=[], name='aggregation_weight')
+            self._accumulate_op = tf.group(
+                *[tf.assign_add(a, tf.cast(v, tf.float64) * self._aggregation_weight_ph)
+                  for a, v in zip(accumulators, all_vars)],
+                tf.assign_add(total_weight, self._aggregation_weight_ph))
+
+            averaged = [tf.assign(g, tf.cast(a / total_weight, g.dtype.base_dtype))
+                        for g, a in zip(self._global_params, accumulators)]
+            with tf.control_dependencies(averaged):
+                self._finalize_aggregation_op = tf.group(
+                    *[tf.assign(a, tf.zeros_like(a)) for a in accumulators],
+                    tf.assign(total_weight, 0.))
+
+            self._load_global_params_op = tf.group(*[
+                tf.assign(v, g) for v, g in zip(all_vars, self._global_params)])
+
+            self._global_flat_params = tf.concat(
+                [tf.reshape(g, [-1]) for g in self._global_params], axis=0)
+            parts = tf.split(self._flat_params_ph, [int(np.prod(s)) for s in self.param_shapes])
+            self._set_global_flat_params_op = tf.group(*[
+                tf.assign(g, tf.reshape(p, shape))
+                for g, p, shape in zip(self._global_params, parts, self.param_shapes)])
+
+            self.sess.run(tf.variables_initializer(self._global_params + accumulators + [total_weight]))
+
+    def accumulate_params(self, weight):
+        """Adds the current weights, scaled by weight, to the in-graph sum."""
+        self.sess.run(self._accumulate_op, feed_dict={self._aggregation_weight_ph: weight})
+
+    def finalize_aggregation(self):
+        """Replaces the global model by the weighted average of the sum.
+
+        The accumulators are reset for the next round.
+        """
+        self.sess.run(self._finalize_aggregation_op)
+
+    def load_global_params(self):
+        """Copies the in-graph global model into the trainable variables."""
+        self.sess.run(self._load_global_params_op)
+
+    def get_global_flat_params(self):
+        """Returns the in-graph global model as a flat float32 np.ndarray."""
+        return self.sess.run(self._global_flat_params)
+
+    def set_global_flat_params(self, flat_params):
+        """Replaces the in-graph global model by the given flat weights."""
+        self.sess.run(self._set_global_flat_params_op,
+                      feed_dict={self._flat_params_ph: flat_params})
+
+    @property
+    def num_params(self):
+        """Number of scalars in all the trainable variables of the model."""
+        return int(self.param_offsets[-1])
+
+    def set_flat_params(self, flat_params):
+        """Loads all trainable variables from a flat vector in one session call.
+
+        Args:
+            flat_params: np.ndarray of num_params elements, as returned by
+                get_flat_params.
+        """
+        self.sess.run(self._set_flat_params_op,
+                      feed_dict={self._flat_params_ph: flat_params})
+
+    def get_flat_params(self):
+        """Returns all trainable variables as a flat float32 np.ndarray."""
+        return self.sess.run(self._flat_params)
+
+    def set_params(self, model_params):
+        self.set_flat_params(self.flatten_params(model_params))
 
     def get_params(self):
-        with self.graph.as_default():
-            model_params = self.sess.run(tf.trainable_variables())
-        return model_params
+        return self.unflatten_params(self.get_flat_params())
+
+    def flatten_params(self, model_params):
+        """Lays out a list of per-variable arrays as a flat float32 vector."""
+        return np.concatenate([np.ravel(v) for v in model_params]).astype(np.float32, copy=False)
+
+    def unflatten_params(self, flat_params):
+        """Splits a flat vector into per-variable views with their shapes."""
+        return [flat_params[self.param_offsets[i]:self.param_offsets[i + 1]].reshape(shape)
+                for i, shape in enumerate(self.param_shapes)]
 
     @property
     def optimizer(self):
@@ -68,6 +213,13 @@ class Model(ABC):
                     the labels, trains the model.
                 eval_metric_ops: A Tensorflow operation that, when run with features and labels,
                     returns the accuracy of the model.
+                loss: A Tensorflow operation that, when run with features and labels,
+                    returns the mean loss of the model.
+
+        Models whose predictions for a sample do not depend on the rest of
+        the batch may also set self.sample_correct and self.sample_loss to
+        tensors holding, for every sample, whether it was predicted correctly
+        and its loss; this enables the batched evaluation of test_many.
         """
         return None, None, None, None, None
 
@@ -81,19 +233,31 @@ class Model(ABC):
             batch_size: Size of training batches.
         Return:
             comp: Number of FLOPs computed while training given data
-            update: List of np.ndarray weights, with each weight array
-                corresponding to a variable in the resulting graph
+            update: flat np.ndarray with the resulting weights, laid out as
+                in get_flat_params
         """
-        for _ in range(num_epochs):
-            self.run_epoch(data, batch_size)
+        comp = self.train_epochs(data, num_epochs, batch_size)
 
-        update = self.get_params()
-        comp = num_epochs * (len(data['y'])//batch_size) * batch_size * self.flops
+        with self.profiler.phase('get_params'):
+            update = self.get_flat_params()
         return comp, update
 
+    def train_epochs(self, data, num_epochs=1, batch_size=10):
+        """Trains the client model, leaving the resulting weights in its variables.
+
+        Args are as in train.
+        Return:
+            comp: Number of FLOPs computed while training given data
+        """
+        with self.profiler.phase('train'):
+            for _ in range(num_epochs):
+                self.run_epoch(data, batch_size)
+
+        return num_epochs * (len(data['y'])//batch_size) * batch_size * self.flops
+
     def run_epoch(self, data, batch_size):
 
-        for batched_x, batched_y in batch_data(data, batch_size, seed=self.seed):
+        for batched_x, batched_y in batch_data(data, batch_size, seed=self.seed, legacy_shuffle=self.legacy_shuffle):
             
             input_data = self.process_x(batched_x)
             target_data = self.process_y(batched_y)
@@ -124,9 +288,82 @@ class Model(ABC):
         acc = float(tot_acc) / x_vecs.shape[0]
         return {ACCURACY_KEY: acc, 'loss': loss}
 
+    @property
+    def supports_test_many(self):
+        """Whether the model defines the per-sample tensors used by test_many."""
+        return self.sample_correct is not None and self.sample_loss is not None
+
+    def test_many(self, datasets):
+        """Tests the current model on several datasets at once.
+
+        The samples of all datasets are packed together into batches of
+        eval_batch_size samples, along with an array holding the index of the
+        dataset each sample comes from; the per-sample results are then
+        reduced into per-dataset metrics with segment sums.
+
+        Args:
+            datasets: list of dicts of the form {'x': [list], 'y': [list]}
+        Return:
+            list with the dict of metrics of each dataset, as returned by test.
+        """
+        lengths = np.array([len(d['y']) for d in datasets], dtype=np.int64)
+        segments = np.repeat(np.arange(len(datasets)), lengths)
+        bounds = np.concatenate([[0], np.cumsum(lengths)])
+        num_samples = int(bounds[-1])
+
+        correct, losses = [], []
+        for i in range(0, num_samples, self.eval_batch_size):
+            end = min(i + self.eval_batch_size, num_samples)
+            x_vecs = self.process_x(_gather_rows([d['x'] for d in datasets], bounds, i, end))
+            labels = self.process_y(_gather_rows([d['y'] for d in datasets], bounds, i, end))
+            with self.graph.as_default():
+                batch_correct, batch_loss = self.sess.run(
+                    [self.sample_correct, self.sample_loss],
+                    feed_dict={self.features: x_vecs, self.labels: labels})
+            correct.append(batch_correct)
+            losses.append(batch_loss)
+
+        if num_samples > 0:
+            correct = np.concatenate(correct).astype(np.float64)
+            losses = np.concatenate(losses).astype(np.float64)
+        tot_correct = np.bincount(segments, weights=correct, minlength=len(datasets))
+        tot_loss = np.bincount(segments, weights=losses, minlength=len(datasets))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            accs = tot_correct / lengths
+            mean_losses = tot_loss / lengths
+        return [{ACCURACY_KEY: float(acc), 'loss': float(loss)}
+                for acc, loss in zip(accs, mean_losses)]
+
     def close(self):
         self.sess.close()
 
+    def encode_user_data(self, user_data):
+        """Encodes the data of a user once, when it is read.
+
+        The result is what process_x and process_y receive, and is stored in
+        the data cache named data_cache_name.
+
+        Args:
+            user_data: dict of the form {'x': [list], 'y': [list]}, as read
+                from the .json files.
+        Return:
+            dict of np.ndarray columns, or None if the data cannot be encoded.
+        """
+        return cache_utils.encode_user_data(user_data)
+
+    def data_cache_key(self):
+        """Describes the inputs of encode_user_data other than the data.
+
+        The data cache is rebuilt when the key changes, e.g. when a
+        vocabulary file is regenerated or a sequence length is changed.
+
+        Return:
+            JSON-serializable value, or None if the encoding only depends
+            on the data.
+        """
+        return None
+
     @abstractmethod
     def process_x(self, raw_x_batch):
         """Pre-processes each batch of features before being fed to the model."""
@@ -138,6 +375,28 @@ class Model(ABC):
         pass
 
 
+def _gather_rows(columns, bounds, start, end):
+    """Returns rows [start, end) of the concatenation of columns.
+
+    Only the slices of the columns that overlap the rows are copied, with a
+    single np.concatenate when they are all np.ndarrays, e.g. views of the
+    data cache; lists are chained.
+
+    Args:
+        columns: list with a column of every dataset.
+        bounds: offsets of the columns in the concatenation, followed by its
+            length.
+    """
+    parts = []
+    j = int(np.searchsorted(bounds, start, side='right')) - 1
+    while j < len(columns) and bounds[j] < end:
+        parts.append(columns[j][max(start - bounds[j], 0):end - bounds[j]])
+        j += 1
+    if all(isinstance(p, np.ndarray) for p in parts):
+        return np.concatenate(parts)
+    return list(itertools.chain.from_iterable(parts))
+
+
 class ServerModel:
     def __init__(self, model):
         self.model = model
@@ -156,17 +415,9 @@ class ServerModel:
         Args:
             clients: list of Client objects
         """
-        var_vals = {}
-        with self.model.graph.as_default():
-            all_vars = tf.trainable_variables()
-            for v in all_vars:
-                val = self.model.sess.run(v)
-                var_vals[v.name] = val
+        flat_params = self.model.get_flat_params()
         for c in clients:
-            with c.model.graph.as_default():
-                all_vars = tf.trainable_variables()
-                for v in all_vars:
-                    v.load(var_vals[v.name], c.model.sess)
+            c.model.set_flat_params(flat_params)
 
     def save(self, path='checkpoints/model.ckpt'):
         return self.model.saver.save(self.model.sess, path)
@@ -0,0 +1,280 @@
+"""Process pools of model replicas used to parallelize the simulation."""
+
+import importlib
+import multiprocessing
+import traceback
+
+import numpy as np
+
+
+def _build_model(model_path, seed, model_params, model_attrs):
+    """Builds a ClientModel replica inside a worker process."""
+    import tensorflow as tf
+
+    tf.logging.set_verbosity(tf.logging.WARN)
+    mod = importlib.import_module(model_path)
+    ClientModel = getattr(mod, 'ClientModel')
+    model = ClientModel(seed, *model_params)
+    for name, value in model_attrs.items():
+        setattr(model, name, value)
+    return model
+
+
+def _train_worker(conn, model_path, seed, model_params, model_attrs):
+    """Trains the clients it receives with its own model replica.
+
+    Every request is a tuple (model_params, tasks); the replica is reset to
+    model_params before each task, and a (comp, update) tuple is sent back
+    per task, in order, as soon as it is available.
+    """
+    model = None
+    try:
+        model = _build_model(model_path, seed, model_params, model_attrs)
+        conn.send(('ready', None))
+        while True:
+            msg = conn.recv()
+            if msg is None:
+                break
+            params, tasks = msg
+            for data, num_epochs, batch_size in tasks:
+                model.set_flat_params(params)
+                conn.send(('ok', model.train(data, num_epochs, batch_size)))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+    finally:
+        if model is not None:
+            model.close()
+        conn.close()
+
+
+def _eval_worker(conn, model_path, seed, model_params, model_attrs, setup_clients, metrics_format,
+                 metrics_dir, metrics_name, eval_set):
+    """Evaluates the global weights it receives with its own model replica.
+
+    The replica's clients are built by setup_clients(model). Every request
+    is a tuple (num_round, model_params, client_indices); the clients are
+    tested on their train and eval_set data, only those in
+    client_indices[set] if it is given, the metrics are written to the stat and summary
+    files, which are flushed, and a (num_round, train_metrics, eval_metrics)
+    tuple is sent back.
+    """
+    import metrics.writer as metrics_writer
+    from server import Server
+
+    server, writers = None, []
+    try:
+        model = _build_model(model_path, seed, model_params, model_attrs)
+        server = Server(model)
+        clients = setup_clients(model)
+        ids, groups, num_samples, num_users = server.get_clients_info(clients)
+        writers = [
+            metrics_writer.get_metrics_writer(metrics_format, metrics_dir, 'stat_{}'.format(metrics_name)),
+            metrics_writer.SummaryWriter(metrics_dir, 'summary_{}'.format(metrics_name)),
+        ]
+        conn.send(('ready', None))
+        while True:
+            msg = conn.recv()
+            if msg is None:
+                break
+            num_round, params, client_indices = msg
+            server.set_model_params(params)
+            result = [num_round]
+            for partition in ('train', eval_set):
+                tested = clients
+                if client_indices is not None:
+                    tested = [clients[i] for i in client_indices[partition]]
+                metrics = server.test_model(tested, set_to_use=partition)
+                tested_ids = [c for c in ids if c in metrics]
+                for writer in writers:
+                    writer.write(num_round, tested_ids, metrics, groups, num_samples, partition, num_users)
+                result.append(metrics)
+            for writer in writers:
+                writer.flush()
+            conn.send(('ok', tuple(result)))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+    finally:
+        for writer in writers:
+            writer.close()
+        if server is not None:
+            server.close_model()
+        conn.close()
+
+
+def _recv(conn):
+    status, payload = conn.recv()
+    if status == 'error':
+        raise RuntimeError('Client worker failed:\n%s' % payload)
+    return payload
+
+
+def split_tasks(costs, num_chunks):
+    """Splits tasks into contiguous chunks of roughly equal total cost.
+
+    Chunks are contiguous so that concatenating the results of every chunk
+    gives back the original task order.
+
+    Args:
+        costs: list with the cost of each task.
+        num_chunks: maximum number of chunks to produce.
+    Return:
+        list of (start, end) index pairs, one per non-empty chunk.
+    """
+    if len(costs) == 0:
+        return []
+    num_chunks = min(num_chunks, len(costs))
+    cum_costs = np.cumsum(costs, dtype=np.float64)
+    targets = cum_costs[-1] * np.arange(1, num_chunks) / num_chunks
+    bounds = np.searchsorted(cum_costs, targets, side='left') + 1
+    bounds = np.unique(np.clip(bounds, 1, len(costs) - 1)) if len(costs) > 1 else []
+    bounds = [0] + [int(b) for b in bounds] + [len(costs)]
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+
+class ClientPool:
+    """Keeps num_workers processes, each one with its own ClientModel.
+
+    Every worker builds its graph and session once; afterwards only the
+    global weights and the clients' data are shipped to it in each round.
+    Workers are started with the 'spawn' method since TensorFlow sessions do
+    not survive a fork.
+    """
+
+    def __init__(self, num_workers, model_path, seed, model_params, model_attrs=None):
+        """
+        Args:
+            num_workers: number of worker processes.
+            model_path: module of the ClientModel, e.g. 'femnist.cnn'.
+            seed: seed of the replicas.
+            model_params: positional arguments of the ClientModel.
+            model_attrs: dict of attributes set on every replica after
+                creating it, e.g. {'legacy_shuffle': True}.
+        """
+        model_attrs = model_attrs or {}
+        ctx = multiprocessing.get_context('spawn')
+        self._conns = []
+        self._workers = []
+        for _ in range(num_workers):
+            parent_conn, child_conn = ctx.Pipe()
+            worker = ctx.Process(
+                target=_train_worker,
+                args=(child_conn, model_path, seed, model_params, model_attrs),
+                daemon=True)
+            worker.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._workers.append(worker)
+        for conn in self._conns:
+            _recv(conn)
+
+    @property
+    def num_workers(self):
+        return len(self._workers)
+
+    def train(self, model_params, tasks):
+        """Trains the given tasks concurrently, starting from model_params.
+
+        Args:
+            model_params: flat global weights every task starts from.
+            tasks: list of (data, num_epochs, batch_size) tuples, as returned
+                by Client.prepare_training.
+        Return:
+            generator of (comp, update) tuples, in the same order as tasks.
+        """
+        costs = [max(1, len(data['y'])) * num_epochs for data, num_epochs, _ in tasks]
+        chunks = split_tasks(costs, self.num_workers)
+        for conn, (start, end) in zip(self._conns, chunks):
+            conn.send((model_params, tasks[start:end]))
+        for conn, (start, end) in zip(self._conns, chunks):
+            for _ in range(start, end):
+                yield _recv(conn)
+
+    def close(self):
+        for conn in self._conns:
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for worker in self._workers:
+            worker.join()
+        for conn in self._conns:
+            conn.close()
+
+
+class AsyncEvaluator:
+    """Evaluates snapshots of the global model in a separate process.
+
+    The process has its own ClientModel and its own copy of the clients,
+    and writes the stat and summary metrics files itself, so training can
+    go on while a round is evaluated. Snapshots are evaluated in the order
+    they are submitted.
+    """
+
+    def __init__(self, model_path, seed, model_params, model_attrs, setup_clients,
+                 metrics_format, metrics_dir, metrics_name, eval_set='test'):
+        """
+        Args:
+            model_path, seed, model_params, model_attrs: as in ClientPool.
+            setup_clients: picklable function returning the list of clients
+                of the model it is given.
+            metrics_format, metrics_dir, metrics_name: as in main.py's
+                arguments; the files written are the stat and summary ones.
+            eval_set: set the clients are evaluated on besides 'train'.
+        """
+        ctx = multiprocessing.get_context('spawn')
+        self._conn, child_conn = ctx.Pipe()
+        self._worker = ctx.Process(
+            target=_eval_worker,
+            args=(child_conn, model_path, seed, model_params, model_attrs or {}, setup_clients,
+                  metrics_format, metrics_dir, metrics_name, eval_set),
+            daemon=True)
+        self._worker.start()
+        child_conn.close()
+        self.num_pending = 0
+        _recv(self._conn)
+
+    def submit(self, num_round, model_params, client_indices=None):
+        """Queues the evaluation of the flat global weights of num_round.
+
+        Args:
+            num_round: round of the weights.
+            model_params: flat global weights.
+            client_indices: optional dict with 'train' and the eval set as
+                keys, and the indices of the clients to test on each set as
+                values; by default, every client is tested.
+        """
+        self._conn.send((num_round, model_params, client_indices))
+        self.num_pending += 1
+
+    def poll(self, block=False):
+        """Returns the evaluations that have finished, in submission order.
+
+        Args:
+            block: whether to wait until every submitted evaluation is done.
+        Return:
+            list of (num_round, train_metrics, eval_metrics) tuples.
+        """
+        results = []
+        while self.num_pending > 0 and (block or self._conn.poll()):
+            results.append(_recv(self._conn))
+            self.num_pending -= 1
+        return results
+
+    def close(self):
+        """Waits for the pending evaluations and stops the process.
+
+        Return:
+            the evaluations that had not been polled yet, as in poll.
+        """
+        results = self.poll(block=True)
+        try:
+            self._conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self._worker.join()
+        self._conn.close()
+        return results
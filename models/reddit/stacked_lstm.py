@@ -8,6 +8,7 @@ import tensorflow as tf
 from tensorflow.contrib import rnn
 
 from model import Model
+from utils.cache_utils import file_key
 
 VOCABULARY_PATH = '../data/reddit/vocab/reddit_vocab.pck'
 
@@ -15,6 +16,8 @@ VOCABULARY_PATH = '../data/reddit/vocab/reddit_vocab.pck'
 # Code adapted from https://github.com/tensorflow/models/blob/master/tutorials/rnn/ptb/ptb_word_lm.py
 # and https://r2rt.com/recurrent-neural-networks-in-tensorflow-iii-variable-length-sequences.html
 class ClientModel(Model):
+    data_cache_name = 'reddit_ids'
+
     def __init__(self, seed, lr, seq_len, n_hidden, num_layers,
         keep_prob=1.0, max_grad_norm=5, init_scale=0.1):
 
@@ -114,6 +117,40 @@ class ClientModel(Model):
         output = tf.reshape(tf.concat(outputs, 1), [-1, self.n_hidden])
         return output, state
 
+    def encode_user_data(self, user_data):
+        """Encodes the comments of a user as int32 token id sequences.
+
+        Every comment is a span of consecutive sequences: x holds the index
+        of its first sequence and y the number of its sequences, so a user
+        still has one sample per comment. The sequences' input and target
+        ids, masks and lengths are stored in the seq_x, seq_y, seq_mask and
+        seq_lengths columns.
+        """
+        try:
+            return self._encode_comments(user_data['x'], user_data['y'])
+        except ValueError:
+            return None
+
+    def _encode_comments(self, comments, targets):
+        counts = np.array([len(c) for c in comments], dtype=np.int32)
+        seq_x = self._tokens_to_ids([seq for c in comments for seq in c])
+        seq_y = self._tokens_to_ids([seq for t in targets for seq in t['target_tokens']])
+        seq_mask = np.array(
+            [m for t in targets for m in t['count_tokens']], dtype=np.float32).reshape(-1, self.seq_len)
+        if not len(seq_x) == len(seq_y) == len(seq_mask):
+            raise ValueError('comments and targets have different numbers of sequences')
+        return {
+            'x': np.cumsum(counts, dtype=np.int32) - counts,
+            'y': counts,
+            'seq_x': seq_x,
+            'seq_y': seq_y,
+            'seq_mask': seq_mask,
+            'seq_lengths': np.sum(seq_x != self.pad_symbol, axis=1, dtype=np.int32),
+        }
+
+    def data_cache_key(self):
+        return {'vocab': file_key(VOCABULARY_PATH), 'seq_len': self.seq_len}
+
     def process_x(self, raw_x_batch):
         tokens = self._tokens_to_ids([s for s in raw_x_batch])
         lengths = np.sum(tokens != self.pad_symbol, axis=1)
@@ -124,50 +161,50 @@ class ClientModel(Model):
         return tokens
 
     def _tokens_to_ids(self, raw_batch):
-        def tokens_to_word_ids(tokens, vocab):
-            return [vocab[word] for word in tokens]
-
-        to_ret = [tokens_to_word_ids(seq, self.vocab) for seq in raw_batch]
-        return np.array(to_ret)
+        if any(len(seq) != self.seq_len for seq in raw_batch):
+            raise ValueError('sequences must have %d tokens' % self.seq_len)
+        ids = [self.vocab.get(word, self.unk_symbol) for seq in raw_batch for word in seq]
+        return np.array(ids, dtype=np.int32).reshape(len(raw_batch), self.seq_len)
 
     def batch_data(self, data, batch_size):
-        data_x = data['x']
-        data_y = data['y']
-
-        perm = np.random.permutation(len(data['x']))
-        data_x = [data_x[i] for i in perm]
-        data_y = [data_y[i] for i in perm]
-
-        # flatten lists
-        def flatten_lists(data_x_by_comment, data_y_by_comment):
-            data_x_by_seq, data_y_by_seq, mask_by_seq = [], [], []
-            for c, l in zip(data_x_by_comment, data_y_by_comment):
-                data_x_by_seq.extend(c)
-                data_y_by_seq.extend(l['target_tokens'])
-                mask_by_seq.extend(l['count_tokens'])
-
-            if len(data_x_by_seq) % batch_size != 0:
-                dummy_tokens = [self.pad_symbol for _ in range(self.seq_len)]
-                dummy_mask = [0 for _ in range(self.seq_len)]
-                num_dummy = batch_size - len(data_x_by_seq) % batch_size
-
-                data_x_by_seq.extend([dummy_tokens for _ in range(num_dummy)])
-                data_y_by_seq.extend([dummy_tokens for _ in range(num_dummy)])
-                mask_by_seq.extend([dummy_mask for _ in range(num_dummy)])
-
-            return data_x_by_seq, data_y_by_seq, mask_by_seq
-        
-        data_x, data_y, data_mask = flatten_lists(data_x, data_y)
+        if 'seq_x' not in data:
+            data = self._encode_comments(data['x'], data['y'])
+
+        # Sequences of the shuffled comments, in order. The comments are
+        # shuffled by a local generator seeded with the model's seed, as in
+        # utils.model_utils.batch_data, so that replicas in worker processes
+        # draw the same batches; legacy_shuffle draws from the global random
+        # state, as the published baselines did.
+        if self.legacy_shuffle:
+            perm = np.random.permutation(len(data['x']))
+        else:
+            perm = np.random.default_rng(self.seed).permutation(len(data['x']))
+        starts, counts = data['x'][perm], data['y'][perm]
+        num_seqs = int(np.sum(counts))
+        seq_idx = np.arange(num_seqs) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+
+        # The last batch is filled up with dummy sequences, masked out of the
+        # loss. They hold the ids the list-based pipeline gave them (the pad
+        # symbol looked up as a word), so the metrics are unchanged.
+        num_dummy = -num_seqs % batch_size
+        dummy_id = self.vocab.get(self.pad_symbol, self.unk_symbol)
+        dummy_tokens = np.full((num_dummy, self.seq_len), dummy_id, dtype=np.int32)
+        dummy_length = np.sum(dummy_tokens[:1] != self.pad_symbol, dtype=np.int32)
+
+        data_x = np.concatenate((data['seq_x'][seq_idx], dummy_tokens))
+        data_y = np.concatenate((data['seq_y'][seq_idx], dummy_tokens))
+        data_mask = np.concatenate(
+            (data['seq_mask'][seq_idx], np.zeros((num_dummy, self.seq_len), dtype=np.float32)))
+        data_lengths = np.concatenate(
+            (data['seq_lengths'][seq_idx], np.full(num_dummy, dummy_length, dtype=np.int32)))
 
         for i in range(0, len(data_x), batch_size):
             batched_x = data_x[i:i+batch_size]
             batched_y = data_y[i:i+batch_size]
             batched_mask = data_mask[i:i+batch_size]
+            input_lengths = data_lengths[i:i+batch_size]
 
-            input_data, input_lengths = self.process_x(batched_x)
-            target_data = self.process_y(batched_y)
-
-            yield (input_data, target_data, input_lengths, batched_mask)
+            yield (batched_x, batched_y, input_lengths, batched_mask)
 
     def run_epoch(self, data, batch_size=5):
         state = None
@@ -6,20 +6,28 @@ import sys
 import tensorflow as tf
 
 from model import Model
-from utils.language_utils import bag_of_words, get_word_emb_arr, val_to_vec
+from utils.cache_utils import file_key
+from utils.language_utils import bag_of_words, bags_of_words, get_word_emb_arr, lines_to_bag_indices, val_to_vec
 
 VOCAB_DIR = 'sent140/embs.json'
 
+# Maximum number of known words per tweet in the cached bag indices. A tweet
+# has at most 140 characters, so at most 140 words.
+MAX_BAG_WORDS = 140
+
 
 class ClientModel(Model):
 
-    def __init__(self, lr, num_classes, input_dim=None):
+    # Tweets are cached as the indices of their known words.
+    data_cache_name = 'sent140_bags'
+
+    def __init__(self, seed, lr, num_classes, input_dim=None):
         self.num_classes = num_classes
         _, _, self.vocab = get_word_emb_arr(VOCAB_DIR)
         if not input_dim:
             input_dim = len(self.vocab)
         self.input_dim = input_dim
-        super(ClientModel, self).__init__(lr)
+        super(ClientModel, self).__init__(seed, lr)
 
     def create_model(self):
         features = tf.placeholder(tf.float32, [None, self.input_dim])
@@ -39,22 +47,37 @@ class ClientModel(Model):
         correct_pred = tf.equal(tf.argmax(pred,1), tf.argmax(labels,1))
         eval_metric_ops = tf.count_nonzero(correct_pred)
         
-        return features, labels, train_op, eval_metric_ops
+        return features, labels, train_op, eval_metric_ops, loss
+
+    def encode_user_data(self, user_data):
+        """Encodes every tweet as the -1-padded indices of its known words."""
+        try:
+            x = lines_to_bag_indices([e[4] for e in user_data['x']], self.vocab, MAX_BAG_WORDS)
+        except ValueError:
+            return None
+        return {'x': x, 'y': np.array([int(e) for e in user_data['y']], dtype=np.int8)}
+
+    def data_cache_key(self):
+        return {'vocab': file_key(VOCAB_DIR), 'max_bag_words': MAX_BAG_WORDS}
 
     def process_x(self, raw_x_batch):
         """
         Return:
             len(vocab) by len(raw_x_batch) np array
         """
+        x_batch = np.asarray(raw_x_batch)
+        if x_batch.dtype.kind == 'i':
+            return bags_of_words(x_batch, self.input_dim)
         x_batch = [e[4] for e in raw_x_batch] # list of lines/phrases
         bags = [bag_of_words(line, self.vocab) for line in x_batch]
         bags = np.array(bags)
         return bags
 
     def process_y(self, raw_y_batch):
+        y_batch = np.asarray(raw_y_batch)
+        if y_batch.dtype.kind == 'i':
+            return np.eye(self.num_classes, dtype=np.float32)[y_batch]
         y_batch = [int(e) for e in raw_y_batch]
         y_batch = [val_to_vec(self.num_classes, e) for e in y_batch]
         y_batch = np.array(y_batch)
         return y_batch
-
-
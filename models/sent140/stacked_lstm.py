@@ -6,7 +6,8 @@ import tensorflow as tf
 from tensorflow.contrib import rnn
 
 from model import Model
-from utils.language_utils import line_to_indices, get_word_emb_arr, val_to_vec
+from utils.cache_utils import file_key
+from utils.language_utils import line_to_indices, lines_to_indices, get_word_emb_arr, val_to_vec
 
 
 VOCAB_DIR = 'sent140/embs.json'
@@ -14,6 +15,9 @@ VOCAB_DIR = 'sent140/embs.json'
 
 class ClientModel(Model):
 
+    # Tweets are cached as padded word indices.
+    data_cache_name = 'sent140_indices'
+
     def __init__(self, seed, lr, seq_len, num_classes, n_hidden, emb_arr=None):
         self.seq_len = seq_len
         self.num_classes = num_classes
@@ -37,23 +41,41 @@ class ClientModel(Model):
         fc1 = tf.layers.dense(inputs=outputs[:, -1, :], units=128)
         pred = tf.layers.dense(inputs=fc1, units=self.num_classes)
         
-        loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits_v2(logits=pred, labels=labels))
+        self.sample_loss = tf.nn.softmax_cross_entropy_with_logits_v2(logits=pred, labels=labels)
+        loss = tf.reduce_mean(self.sample_loss)
         train_op = self.optimizer.minimize(
             loss=loss,
             global_step=tf.train.get_global_step())
         
         correct_pred = tf.equal(tf.argmax(pred, 1), tf.argmax(labels, 1))
         eval_metric_ops = tf.count_nonzero(correct_pred)
+        self.sample_correct = correct_pred
         
         return features, labels, train_op, eval_metric_ops, loss
 
+    def encode_user_data(self, user_data):
+        """Encodes every tweet as seq_len word indices and labels as ints."""
+        return {
+            'x': lines_to_indices([e[4] for e in user_data['x']], self.indd, self.seq_len),
+            'y': np.array([int(e) for e in user_data['y']], dtype=np.int8),
+        }
+
+    def data_cache_key(self):
+        return {'vocab': file_key(VOCAB_DIR), 'seq_len': self.seq_len}
+
     def process_x(self, raw_x_batch, max_words=25):
+        x_batch = np.asarray(raw_x_batch)
+        if x_batch.dtype.kind == 'i':
+            return x_batch
         x_batch = [e[4] for e in raw_x_batch]
         x_batch = [line_to_indices(e, self.indd, max_words) for e in x_batch]
         x_batch = np.array(x_batch)
         return x_batch
 
     def process_y(self, raw_y_batch):
+        y_batch = np.asarray(raw_y_batch)
+        if y_batch.dtype.kind == 'i':
+            return np.eye(self.num_classes, dtype=np.float32)[y_batch]
         y_batch = [int(e) for e in raw_y_batch]
         y_batch = [val_to_vec(self.num_classes, e) for e in y_batch]
         y_batch = np.array(y_batch)
@@ -1,20 +1,50 @@
-import numpy as np
-
+from aggregator import StreamingAggregator
 from baseline_constants import BYTES_WRITTEN_KEY, BYTES_READ_KEY, LOCAL_COMPUTATIONS_KEY
+from utils.profiler import NullProfiler
+from utils.sampling_utils import ClientSampler
 
 class Server:
     
-    def __init__(self, client_model):
+    def __init__(self, client_model, client_pool=None, profiler=None, graph_aggregation=False,
+                 seed=0, legacy_sampling=False):
+        """
+        Args:
+            client_model: model shared by the clients.
+            client_pool: optional ClientPool training the clients concurrently.
+            profiler: optional Profiler timing the phases of the rounds.
+            graph_aggregation: whether to keep the global model and the
+                weighted sum of the updates as variables in the graph of
+                client_model, instead of as np.ndarrays. Clients are then
+                trained one after the other, without a client pool.
+            seed: seed of the client selection.
+            legacy_sampling: whether to select clients exactly as the
+                published baselines did; see ClientSampler.
+        """
         self.client_model = client_model
-        self.model = client_model.get_params()
+        self.client_pool = client_pool
+        self.profiler = profiler if profiler is not None else NullProfiler()
+        self.graph_aggregation = graph_aggregation
         self.selected_clients = []
-        self.updates = []
+        self.seed = seed
+        self.legacy_sampling = legacy_sampling
+        self._sampler = None
+        self._sampler_clients = None
+        if graph_aggregation:
+            if client_pool is not None:
+                raise ValueError('In-graph aggregation cannot be used with a client pool')
+            client_model.enable_graph_aggregation()
+            self.model = None
+            self.aggregator = None
+        else:
+            self.model = client_model.get_flat_params()
+            self.aggregator = StreamingAggregator(client_model.num_params)
 
     def select_clients(self, my_round, possible_clients, num_clients=20):
         """Selects num_clients clients randomly from possible_clients.
         
-        Note that within function, num_clients is set to
-            min(num_clients, len(possible_clients)).
+        Clients are drawn without replacement, with probabilities
+        proportional to their number of users. Note that within function,
+        num_clients is set to min(num_clients, len(possible_clients)).
 
         Args:
             possible_clients: Clients from which the server can select.
@@ -23,18 +53,27 @@ class Server:
             list of (num_train_samples, num_test_samples)
         """
 
-        num_users = [c.num_users for c in possible_clients]
-        total_users = sum(num_users)
-        p_dist = [n / total_users for n in num_users]
-
-        num_clients = min(num_clients, len(possible_clients))
-        np.random.seed(my_round)
-        self.selected_clients = np.random.choice(possible_clients, num_clients, replace=False, p=p_dist)
+        with self.profiler.phase('select'):
+            sampler = self._get_sampler(possible_clients)
+            indices = sampler.sample(my_round, num_clients)
+            self.selected_clients = [possible_clients[i] for i in indices]
 
         print("Num users in each client:", [c.num_users for c in self.selected_clients])
 
         return [(c.num_train_samples, c.num_test_samples) for c in self.selected_clients]
 
+    def _get_sampler(self, possible_clients):
+        """Returns the sampler of possible_clients, weighted by their number of users.
+
+        The sampler is built once and reused while the same list of clients
+        is given.
+        """
+        if self._sampler_clients is not possible_clients or self._sampler.num_clients != len(possible_clients):
+            self._sampler = ClientSampler(
+                [c.num_users for c in possible_clients], self.seed, self.legacy_sampling)
+            self._sampler_clients = possible_clients
+        return self._sampler
+
     def train_model(self, num_epochs=1, batch_size=10, minibatch=None, clients=None):
         """Trains self.model on given clients.
         
@@ -62,46 +101,113 @@ class Server:
             c.id: {BYTES_WRITTEN_KEY: 0,
                    BYTES_READ_KEY: 0,
                    LOCAL_COMPUTATIONS_KEY: 0} for c in clients}
-        for c in clients:
-            c.model.set_params(self.model)
-            comp, num_samples, update = c.train(num_epochs, batch_size, minibatch)
-
+        for c, (comp, num_samples, update) in zip(clients, self._train_clients(clients, num_epochs, batch_size, minibatch)):
             sys_metrics[c.id][BYTES_READ_KEY] += c.model.size
             sys_metrics[c.id][BYTES_WRITTEN_KEY] += c.model.size
             sys_metrics[c.id][LOCAL_COMPUTATIONS_KEY] = comp
 
-            self.updates.append((num_samples, update))
+            with self.profiler.client(c.id), self.profiler.phase('aggregate'):
+                if self.graph_aggregation:
+                    # The trained weights of c are still in the variables
+                    c.model.accumulate_params(num_samples)
+                else:
+                    self.aggregator.add(num_samples, update)
 
         return sys_metrics
 
-    def update_model(self):
-        total_weight = 0.
-        base = [0] * len(self.updates[0][1])
-        for (client_samples, client_model) in self.updates:
-            total_weight += client_samples
-            for i, v in enumerate(client_model):
-                base[i] += (client_samples * v.astype(np.float64))
-        averaged_soln = [v / total_weight for v in base]
+    def _train_clients(self, clients, num_epochs, batch_size, minibatch):
+        """Yields (comp, num_samples, update) for each client, in order.
 
-        self.model = averaged_soln
-        self.updates = []
+        Clients are trained one after the other on the shared model, unless
+        a client pool is available, in which case they are trained
+        concurrently by its model replicas. In that case, the time profiled
+        as the training of a client is the time spent waiting for its
+        result. With in-graph aggregation, update is None and the trained
+        weights are left in the client's model.
+        """
+        profiler = self.profiler
+        if self.client_pool is None:
+            for c in clients:
+                with profiler.client(c.id):
+                    with profiler.phase('set_params'):
+                        self._load_model(c.model)
+                    with profiler.phase('load_data'):
+                        data, c_num_epochs, c_batch_size = c.prepare_training(num_epochs, batch_size, minibatch)
+                    if self.graph_aggregation:
+                        comp, update = c.model.train_epochs(data, c_num_epochs, c_batch_size), None
+                    else:
+                        comp, update = c.model.train(data, c_num_epochs, c_batch_size)
+                yield comp, len(data['y']), update
+            return
+
+        tasks = []
+        for c in clients:
+            with profiler.client(c.id), profiler.phase('load_data'):
+                tasks.append(c.prepare_training(num_epochs, batch_size, minibatch))
+        results = self.client_pool.train(self.model, tasks)
+        for c, (data, _, _) in zip(clients, tasks):
+            with profiler.client(c.id), profiler.phase('train'):
+                comp, update = next(results)
+            yield comp, len(data['y']), update
+
+    def update_model(self):
+        """Replaces self.model by the weighted average of this round's updates."""
+        with self.profiler.phase('update'):
+            if self.graph_aggregation:
+                self.client_model.finalize_aggregation()
+            else:
+                self.model = self.aggregator.result()
+                self.aggregator.reset()
+
+    def get_model_params(self):
+        """Returns the global model as a flat np.ndarray."""
+        if self.graph_aggregation:
+            return self.client_model.get_global_flat_params()
+        return self.model
+
+    def set_model_params(self, params):
+        """Replaces the global model by the given flat weights."""
+        if self.graph_aggregation:
+            self.client_model.set_global_flat_params(params)
+        else:
+            self.model = params
+
+    def _load_model(self, model):
+        """Loads the global model into the variables of the given model."""
+        if self.graph_aggregation:
+            model.load_global_params()
+        else:
+            model.set_flat_params(self.model)
 
     def test_model(self, clients_to_test, set_to_use='test'):
         """Tests self.model on given clients.
 
         Tests model on self.selected_clients if clients_to_test=None.
 
+        The global weights are loaded once, since all clients share the same
+        model. If the model supports it, all clients are then scored together
+        in large batches; otherwise they are tested one by one.
+
         Args:
             clients_to_test: list of Client objects.
             set_to_use: dataset to test on. Should be in ['train', 'test'].
         """
-        metrics = {}
-
         if clients_to_test is None:
             clients_to_test = self.selected_clients
 
+        with self.profiler.phase('eval_%s' % set_to_use):
+            return self._test_clients(clients_to_test, set_to_use)
+
+    def _test_clients(self, clients_to_test, set_to_use):
+        self._load_model(self.client_model)
+
+        if self.client_model.supports_test_many:
+            datasets = [client.get_data(set_to_use) for client in clients_to_test]
+            c_metrics = self.client_model.test_many(datasets)
+            return {client.id: m for client, m in zip(clients_to_test, c_metrics)}
+
+        metrics = {}
         for client in clients_to_test:
-            client.model.set_params(self.model)
             c_metrics = client.test(set_to_use)
             metrics[client.id] = c_metrics
         
@@ -127,9 +233,11 @@ class Server:
     def save_model(self, path):
         """Saves the server model on checkpoints/dataset/model.ckpt."""
         # Save server model
-        self.client_model.set_params(self.model)
+        self._load_model(self.client_model)
         model_sess =  self.client_model.sess
         return self.client_model.saver.save(model_sess, path)
 
     def close_model(self):
-        self.client_model.close()
\ No newline at end of file
+        self.client_model.close()
+        if self.client_pool is not None:
+            self.client_pool.close()
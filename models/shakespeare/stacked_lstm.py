@@ -6,9 +6,13 @@ import tensorflow as tf
 from tensorflow.contrib import rnn
 
 from model import Model
-from utils.language_utils import letter_to_vec, word_to_indices
+from utils.language_utils import letters_to_indices, words_to_indices
 
 class ClientModel(Model):
+
+    # Sequences and labels are cached as character indices.
+    data_cache_name = 'shakespeare_indices'
+
     def __init__(self, seed, lr, seq_len, num_classes, n_hidden):
         self.seq_len = seq_len
         self.num_classes = num_classes
@@ -19,29 +23,46 @@ class ClientModel(Model):
         features = tf.placeholder(tf.int32, [None, self.seq_len])
         embedding = tf.get_variable("embedding", [self.num_classes, 8])
         x = tf.nn.embedding_lookup(embedding, features)
-        labels = tf.placeholder(tf.int32, [None, self.num_classes])
+        labels = tf.placeholder(tf.int32, [None])
         
         stacked_lstm = rnn.MultiRNNCell(
             [rnn.BasicLSTMCell(self.n_hidden) for _ in range(2)])
         outputs, _ = tf.nn.dynamic_rnn(stacked_lstm, x, dtype=tf.float32)
         pred = tf.layers.dense(inputs=outputs[:,-1,:], units=self.num_classes)
         
-        loss = tf.reduce_mean(
-            tf.nn.softmax_cross_entropy_with_logits_v2(logits=pred, labels=labels))
+        self.sample_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=pred, labels=labels)
+        loss = tf.reduce_mean(self.sample_loss)
         train_op = self.optimizer.minimize(
             loss=loss,
             global_step=tf.train.get_global_step())
 
-        correct_pred = tf.equal(tf.argmax(pred, 1), tf.argmax(labels, 1))
+        correct_pred = tf.equal(tf.argmax(pred, 1, output_type=tf.int32), labels)
         eval_metric_ops = tf.count_nonzero(correct_pred)
+        self.sample_correct = correct_pred
 
         return features, labels, train_op, eval_metric_ops, loss
 
+    def encode_user_data(self, user_data):
+        """Encodes the sequences and next characters as int8 indices."""
+        try:
+            return {
+                'x': words_to_indices(user_data['x'], self.seq_len),
+                'y': letters_to_indices(user_data['y']),
+            }
+        except ValueError:
+            return None
+
+    def data_cache_key(self):
+        return {'seq_len': self.seq_len}
+
     def process_x(self, raw_x_batch):
-        x_batch = [word_to_indices(word) for word in raw_x_batch]
-        x_batch = np.array(x_batch)
-        return x_batch
+        x_batch = np.asarray(raw_x_batch)
+        if x_batch.dtype.kind == 'i':
+            return x_batch
+        return words_to_indices(list(raw_x_batch), self.seq_len)
 
     def process_y(self, raw_y_batch):
-        y_batch = [letter_to_vec(c) for c in raw_y_batch]
-        return y_batch
+        y_batch = np.asarray(raw_y_batch)
+        if y_batch.dtype.kind == 'i':
+            return y_batch
+        return letters_to_indices(list(raw_y_batch))
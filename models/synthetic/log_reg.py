@@ -32,17 +32,19 @@ class ClientModel(Model):
         predictions = tf.argmax(logits, axis=-1)
         correct_pred = tf.equal(predictions, labels)
         eval_metric_ops = tf.count_nonzero(correct_pred)
+        self.sample_correct = correct_pred
+        self.sample_loss = loss
         
         return features, labels, train_op, eval_metric_ops, tf.reduce_mean(loss)
 
     def process_x(self, raw_x_batch):
-        return np.array(raw_x_batch)
+        return np.asarray(raw_x_batch)
 
     def process_y(self, raw_y_batch):
-        return np.array(raw_y_batch)
+        return np.asarray(raw_y_batch)
 
     def _run_epoch(self, data, batch_size):
-        for batched_x, batched_y in batch_data(data, batch_size, self.seed):
+        for batched_x, batched_y in batch_data(data, batch_size, self.seed, self.legacy_shuffle):
             input_data = self.process_x(batched_x)
             target_data = self.process_y(batched_y)
 
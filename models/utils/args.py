@@ -46,9 +46,41 @@ def parse_args():
                     type=str,
                     default='metrics',
                     required=False)
+    parser.add_argument('--profile',
+                    help='record the wall and cpu time of every phase of the rounds in a timing metrics file;',
+                    action='store_true')
+    parser.add_argument('--metrics-format',
+                    help='format of the metrics files; parquet requires pyarrow;',
+                    type=str,
+                    choices=['csv', 'parquet'],
+                    default='csv')
     parser.add_argument('--use-val-set', 
                     help='use validation set;', 
                     action='store_true')
+    parser.add_argument('--legacy-sampling',
+                    help='select clients by reseeding the global numpy random state with the round number, as the published baselines did;',
+                    action='store_true')
+    parser.add_argument('--legacy-shuffle',
+                    help='shuffle batches with the global random state, reproducing the published baselines;',
+                    action='store_true')
+    parser.add_argument('--no-data-cache',
+                    help='always parse the .json data files instead of using their binary cache;',
+                    dest='data_cache',
+                    action='store_false')
+    parser.add_argument('--celeba-image-lru-size',
+                    help='number of decoded celeba images kept in an lru cache instead of memory-mapping the image cache; 0 uses the image cache;',
+                    type=int,
+                    default=0)
+    parser.add_argument('--client-workers',
+                    help='number of worker processes training clients concurrently; 0 trains them serially;',
+                    type=int,
+                    default=0)
+    parser.add_argument('--async-eval',
+                    help='evaluate the model in a separate process, which writes the stat metrics, while training goes on;',
+                    action='store_true')
+    parser.add_argument('--graph-aggregation',
+                    help='keep the global model and the sum of the updates in the model graph; not with --client-workers;',
+                    action='store_true')
 
     # Minibatch doesn't support num_epochs, so make them mutually exclusive
     epoch_capability_group = parser.add_mutually_exclusive_group()
@@ -73,6 +105,22 @@ def parse_args():
                     required=False)
 
     
+    parser.add_argument('--eval-train-fraction',
+                    help='fraction of the clients, drawn once, whose train metrics are computed in every evaluation;',
+                    type=float,
+                    default=1.)
+    parser.add_argument('--eval-fraction',
+                    help='fraction of the clients, drawn by stratified sampling, evaluated in the intermediate evaluations;',
+                    type=float,
+                    default=1.)
+    parser.add_argument('--eval-strata',
+                    help='number of strata, by number of eval samples, of the sampled evaluations;',
+                    type=int,
+                    default=5)
+    parser.add_argument('--eval-confidence',
+                    help='coverage of the confidence intervals of the sampled evaluations;',
+                    type=float,
+                    default=0.95)
     parser.add_argument('--target-performance',
                     help='Stop training 10 rounds after reaching this target performance on the test set;',
                     type=float,
@@ -0,0 +1,311 @@
+"""On-disk binary cache of the train/test JSON data directories.
+
+The first time a data directory is read, its users' data are encoded into
+one contiguous .npy array per column (e.g. 'x' and 'y'), which are written
+to a cache directory next to the JSON files, together with an index.json
+holding the users and, for every column, the offset and length of each
+user's rows. Later runs memory-map the arrays instead of parsing the JSON
+files. The cache is rebuilt whenever the name, size or modification time of
+any source JSON file changes, or when the cache key given by the model,
+which describes the other inputs of its encoder (e.g. a vocabulary file
+and a sequence length), changes.
+
+Caches are built in a temporary directory next to their final location and
+moved there with os.replace, so that processes sharing a data directory
+never see a partially written cache, nor delete one that is in use.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+from collections.abc import Mapping
+
+import numpy as np
+
+
+CACHE_DIR = '.npcache'
+CACHE_VERSION = 1
+INDEX_FILE = 'index.json'
+
+# Array kinds that can be memory-mapped: bool, ints, unsigned ints, floats
+# and fixed-width unicode strings.
+_CACHEABLE_KINDS = 'biufU'
+
+
+def source_fingerprint(data_dir):
+    """Returns the (name, size, mtime) of every JSON file in data_dir."""
+    files = sorted(f for f in os.listdir(data_dir) if f.endswith('.json'))
+    fingerprint = []
+    for f in files:
+        stat = os.stat(os.path.join(data_dir, f))
+        fingerprint.append([f, stat.st_size, stat.st_mtime_ns])
+    return fingerprint
+
+
+def file_key(path):
+    """Returns the [size, mtime] of a file, for cache keys."""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def encode_array(values):
+    """Converts the given list into a np.ndarray that can be memory-mapped.
+
+    Floats are stored as float32, the precision the models use.
+
+    Return:
+        np.ndarray, or None if values are ragged, of mixed types or not
+        numbers or strings.
+    """
+    try:
+        arr = np.asarray(values)
+    except ValueError:
+        return None
+    if arr.dtype.kind not in _CACHEABLE_KINDS or arr.tolist() != list(values):
+        return None
+    if arr.dtype.kind == 'f':
+        arr = arr.astype(np.float32)
+    return arr
+
+
+def encode_user_data(user_data):
+    """Default encoder: stores the 'x' and 'y' lists of a user as arrays.
+
+    Args:
+        user_data: dict of the form {'x': [list], 'y': [list]}
+    Return:
+        dict with the np.ndarray of each column, or None if the user's data
+        cannot be stored as arrays.
+    """
+    encoded = {}
+    for key in ('x', 'y'):
+        arr = encode_array(user_data[key])
+        if arr is None:
+            return None
+        encoded[key] = arr
+    return encoded
+
+
+class UserData(Mapping):
+    """Lazy view of the rows of a user in the memory-mapped cache.
+
+    It only holds the user's offset and length into each column, so it can
+    be kept around for every user during the whole run; indexing it by a
+    column name returns a memory-mapped slice, and materialize loads the
+    user's data in memory.
+    """
+
+    __slots__ = ('_columns', '_offsets', '_lengths')
+
+    def __init__(self, columns, offsets, lengths):
+        """
+        Args:
+            columns: dict with column names as keys and the arrays of all
+                users as values.
+            offsets: dict with the first row of the user in each column.
+            lengths: dict with the number of rows of the user in each column.
+        """
+        self._columns = columns
+        self._offsets = offsets
+        self._lengths = lengths
+
+    def __getitem__(self, name):
+        offset = self._offsets[name]
+        return self._columns[name][offset:offset + self._lengths[name]]
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._columns)
+
+    @property
+    def num_samples(self):
+        """Number of samples of the user, read from the index."""
+        return self._lengths['y']
+
+    def materialize(self):
+        """Returns a dict with the user's columns loaded as np.ndarray."""
+        return {name: np.array(self[name]) for name in self._columns}
+
+
+def num_samples(data):
+    """Number of samples in data, without loading cached data in memory."""
+    if data is None:
+        return 0
+    if isinstance(data, UserData):
+        return data.num_samples
+    return len(data['y'])
+
+
+def materialize(data):
+    """Returns data with its columns in memory if it is a UserData view."""
+    if isinstance(data, UserData):
+        return data.materialize()
+    return data
+
+
+def encode_users(users, data, encode_fn=encode_user_data):
+    """Encodes the data of every user with encode_fn.
+
+    Return:
+        list with the dict of columns of each user, or None if any user's
+        data cannot be encoded or users do not share the same columns.
+    """
+    encoded = []
+    for u in users:
+        user_columns = encode_fn(data[u])
+        if user_columns is None or (encoded and set(user_columns) != set(encoded[0])):
+            return None
+        encoded.append(user_columns)
+    return encoded
+
+
+def _cache_path(data_dir, cache_name):
+    return os.path.join(data_dir, CACHE_DIR, cache_name)
+
+
+def _normalize_key(cache_key):
+    """Returns cache_key as it is read back from index.json."""
+    return json.loads(json.dumps(cache_key))
+
+
+def load_cache(data_dir, cache_name='raw', cache_key=None):
+    """Opens the cache of data_dir, if there is an up-to-date one.
+
+    The cache is up to date if it was built from the current JSON files,
+    with the same JSON-serializable cache_key.
+
+    Return:
+        None if there is no valid cache. Otherwise, the cache's index dict,
+        with a 'columns' entry mapping every column name to a dict holding
+        its memory-mapped 'array' and the 'offsets' and 'lengths' of each
+        user's rows, in the order of index['users']. If the data could not
+        be cached, index['cacheable'] is False and there are no columns.
+    """
+    return _open_cache(
+        _cache_path(data_dir, cache_name), source_fingerprint(data_dir), _normalize_key(cache_key))
+
+
+def _read_index(cache_dir, fingerprint, cache_key):
+    """Returns the index of the cache in cache_dir, or None if it is missing
+    or does not match fingerprint and cache_key."""
+    index_path = os.path.join(cache_dir, INDEX_FILE)
+    if not os.path.isfile(index_path):
+        return None
+    with open(index_path, 'r') as inf:
+        index = json.load(inf)
+    if (index.get('version') != CACHE_VERSION or index.get('fingerprint') != fingerprint
+            or index.get('key') != cache_key):
+        return None
+    return index
+
+
+def _open_cache(cache_dir, fingerprint, cache_key):
+    index = _read_index(cache_dir, fingerprint, cache_key)
+    if index is None:
+        return None
+    for name, column in index['columns'].items():
+        column['array'] = np.load(os.path.join(cache_dir, '%s.npy' % name), mmap_mode='r')
+    return index
+
+
+def _swap_in(tmp_dir, cache_dir, fingerprint, cache_key):
+    """Moves tmp_dir to cache_dir, unless cache_dir holds an up-to-date cache.
+
+    An up-to-date cache, e.g. one that another process has just built, is
+    never replaced, since other processes may be opening it. A stale one is
+    first moved aside, since os.replace cannot replace a non-empty
+    directory, and deleted; processes that memory-mapped its arrays keep
+    reading them. If another process swaps in its cache in between, that
+    cache is kept.
+    """
+    if _read_index(cache_dir, fingerprint, cache_key) is not None:
+        return
+    stale_dir = None
+    if os.path.isdir(cache_dir):
+        stale_dir = tempfile.mkdtemp(prefix=os.path.basename(cache_dir) + '.stale.',
+                                     dir=os.path.dirname(cache_dir))
+        try:
+            os.replace(cache_dir, stale_dir)
+        except FileNotFoundError:
+            # Another process moved it aside first
+            pass
+    try:
+        os.replace(tmp_dir, cache_dir)
+    except OSError:
+        # Another process swapped in its cache first
+        pass
+    if stale_dir is not None:
+        shutil.rmtree(stale_dir, ignore_errors=True)
+
+
+def build_cache(data_dir, users, groups, unions, data, cache_name='raw', encode_fn=encode_user_data,
+                cache_key=None):
+    """Writes the cache of data_dir from its already parsed JSON data.
+
+    Args:
+        data_dir: directory with the source JSON files.
+        users: list of user ids.
+        groups: list of the users' hierarchies; may be empty.
+        unions: list of the users' union lists; may be empty.
+        data: dict with user ids as keys and their data as values.
+        cache_name: name distinguishing caches built with different encoders.
+        encode_fn: function mapping the data of a user to a dict of
+            np.ndarray columns, or None if it cannot be encoded.
+        cache_key: JSON-serializable description of the other inputs of
+            encode_fn; the cache is rebuilt when it changes.
+    Return:
+        the cache's index, as returned by load_cache.
+    """
+    fingerprint = source_fingerprint(data_dir)
+    cache_key = _normalize_key(cache_key)
+    cache_dir = _cache_path(data_dir, cache_name)
+    os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=cache_name + '.', dir=os.path.dirname(cache_dir))
+    try:
+        # The cache is opened before it is swapped in, so the arrays stay
+        # valid if another process's cache is kept instead.
+        _write_cache(tmp_dir, fingerprint, cache_key, users, groups, unions, data, encode_fn)
+        index = _open_cache(tmp_dir, fingerprint, cache_key)
+        _swap_in(tmp_dir, cache_dir, fingerprint, cache_key)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return index
+
+
+def _write_cache(cache_dir, fingerprint, cache_key, users, groups, unions, data, encode_fn):
+    index = {
+        'version': CACHE_VERSION,
+        'fingerprint': fingerprint,
+        'key': cache_key,
+        'users': users,
+        'groups': groups,
+        'unions': unions,
+        'cacheable': True,
+        'columns': {},
+    }
+
+    encoded = encode_users(users, data, encode_fn)
+    index['cacheable'] = encoded is not None
+
+    if index['cacheable'] and encoded:
+        for name in encoded[0]:
+            arrays = [user_columns[name] for user_columns in encoded]
+            non_empty = [a for a in arrays if len(a) > 0]
+            if len(set((a.dtype.kind, a.shape[1:]) for a in non_empty)) > 1:
+                index['cacheable'] = False
+                index['columns'] = {}
+                break
+            lengths = [len(a) for a in arrays]
+            column = np.concatenate(non_empty) if non_empty else np.asarray(arrays[0])
+            np.save(os.path.join(cache_dir, '%s.npy' % name), column)
+            index['columns'][name] = {
+                'offsets': np.concatenate(([0], np.cumsum(lengths)[:-1])).tolist(),
+                'lengths': lengths,
+            }
+
+    with open(os.path.join(cache_dir, INDEX_FILE), 'w') as outf:
+        json.dump(index, outf)
@@ -0,0 +1,155 @@
+"""Evaluation of the global model on samples of the clients.
+
+An EvalPolicy decides which clients are evaluated in each evaluation
+round, and the resulting ClientSample estimates the weighted mean of a
+metric over all the clients, with a confidence interval, from the metrics
+of the sampled ones.
+"""
+
+import math
+
+import numpy as np
+
+
+# Smallest number of clients sampled from a stratum, so that its variance
+# can be estimated.
+MIN_STRATUM_SAMPLE = 2
+
+
+def normal_quantile(confidence):
+    """Returns z such that P(-z <= Z <= z) = confidence for a standard normal Z."""
+    low, high = 0., 10.
+    for _ in range(64):
+        mid = (low + high) / 2
+        if math.erf(mid / math.sqrt(2)) < confidence:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+
+class ClientSample:
+    """Clients drawn from each stratum without replacement."""
+
+    def __init__(self, indices, strata, stratum_sizes):
+        """
+        Args:
+            indices: np.ndarray with the indices of the sampled clients.
+            strata: np.ndarray with the stratum of every sampled client.
+            stratum_sizes: np.ndarray with the number of clients of every
+                stratum.
+        """
+        self.indices = indices
+        self.strata = strata
+        self.stratum_sizes = stratum_sizes
+
+    @property
+    def num_clients(self):
+        """Number of clients sampled from."""
+        return int(self.stratum_sizes.sum())
+
+    @property
+    def is_full(self):
+        return len(self.indices) == self.num_clients
+
+    def estimate(self, values, weights, confidence=0.95):
+        """Estimates the weighted mean of a metric over all the clients.
+
+        Uses the combined ratio estimator of stratified sampling: the
+        weighted sums of the metric and of the weights are extrapolated from
+        every stratum's sample to the whole stratum, and the interval comes
+        from the linearized variance of their ratio, with the finite
+        population correction. A full sample gives the exact weighted mean
+        and an empty interval.
+
+        Args:
+            values: value of the metric of every sampled client, in the
+                order of indices.
+            weights: weight of every sampled client, in the same order.
+            confidence: coverage of the interval.
+        Return:
+            (estimate, lower bound, upper bound)
+        """
+        values = np.asarray(values, dtype=np.float64)
+        weights = np.asarray(weights, dtype=np.float64)
+        num_strata = len(self.stratum_sizes)
+        sampled = np.bincount(self.strata, minlength=num_strata)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            expansion = (self.stratum_sizes / sampled)[self.strata]
+            total_weight = np.sum(expansion * weights)
+            estimate = np.sum(expansion * weights * values) / total_weight
+
+            residuals = weights * (values - estimate)
+            means = np.bincount(self.strata, residuals, num_strata) / sampled
+            squares = np.bincount(self.strata, (residuals - means[self.strata]) ** 2, num_strata)
+            variances = np.where(sampled > 1, squares / (sampled - 1), 0.)
+            fpc = 1. - sampled / self.stratum_sizes
+            variance = np.sum(np.where(sampled > 0, self.stratum_sizes ** 2 * fpc * variances / sampled, 0.))
+        half_width = normal_quantile(confidence) * math.sqrt(max(variance, 0.)) / total_weight
+        return estimate, estimate - half_width, estimate + half_width
+
+
+class EvalPolicy:
+    """Decides which clients are evaluated in each evaluation round.
+
+    By default, every client is evaluated on every set. With
+    train_fraction < 1, the train metrics are computed on a fixed random
+    subset of the clients, drawn once. With eval_fraction < 1, the eval
+    metrics are computed on a stratified sample drawn anew every round: the
+    clients are split into num_strata strata of equal size by their number
+    of eval samples, and every stratum contributes the same fraction of its
+    clients, and at least MIN_STRATUM_SAMPLE. Final evaluations always
+    cover every client.
+    """
+
+    def __init__(self, eval_sizes, train_fraction=1., eval_fraction=1., num_strata=1, seed=0):
+        """
+        Args:
+            eval_sizes: number of eval samples of every client.
+            train_fraction: fraction of the clients evaluated on their train
+                data.
+            eval_fraction: fraction of the clients evaluated on their eval
+                data in intermediate rounds.
+            num_strata: number of strata of the eval samples.
+            seed: seed of the samples.
+        """
+        self.num_clients = len(eval_sizes)
+        self.train_fraction = train_fraction
+        self.eval_fraction = eval_fraction
+        self.seed = seed
+
+        order = np.argsort(np.asarray(eval_sizes), kind='stable')
+        self._strata = np.empty(self.num_clients, dtype=np.int64)
+        for stratum, members in enumerate(np.array_split(order, min(num_strata, max(1, self.num_clients)))):
+            self._strata[members] = stratum
+        self._stratum_sizes = np.bincount(self._strata)
+
+        rng = np.random.default_rng([seed])
+        self._train_sample = self._draw(
+            rng, np.zeros(self.num_clients, dtype=np.int64), np.array([self.num_clients]), train_fraction)
+
+    def sample(self, set_to_use, num_round, final=False):
+        """Returns the ClientSample to evaluate on set_to_use in num_round."""
+        if final:
+            return self._full_sample()
+        if set_to_use == 'train':
+            return self._train_sample
+        rng = np.random.default_rng([self.seed, num_round])
+        return self._draw(rng, self._strata, self._stratum_sizes, self.eval_fraction)
+
+    def _full_sample(self):
+        return ClientSample(
+            np.arange(self.num_clients), np.zeros(self.num_clients, dtype=np.int64), np.array([self.num_clients]))
+
+    def _draw(self, rng, strata, stratum_sizes, fraction):
+        if fraction >= 1:
+            return self._full_sample()
+        indices, sample_strata = [], []
+        for stratum, size in enumerate(stratum_sizes):
+            members = np.flatnonzero(strata == stratum)
+            num_sampled = min(size, max(MIN_STRATUM_SAMPLE, int(round(fraction * size))))
+            indices.append(rng.choice(members, num_sampled, replace=False))
+            sample_strata.append(np.full(num_sampled, stratum, dtype=np.int64))
+        indices, sample_strata = np.concatenate(indices), np.concatenate(sample_strata)
+        order = np.argsort(indices)
+        return ClientSample(indices[order], sample_strata[order], stratum_sizes)
@@ -3,6 +3,8 @@
 import re
 import numpy as np
 import json
+import os
+import tempfile
 
 
 # ------------------------
@@ -27,6 +29,53 @@ def letter_to_vec(letter):
     return _one_hot(index, NUM_LETTERS)
 
 
+# Maps the code point of every ASCII character to its index in ALL_LETTERS;
+# -1, as returned by ALL_LETTERS.find, for the rest.
+_LETTER_INDICES = np.full(128, -1, dtype=np.int8)
+_LETTER_INDICES[[ord(c) for c in ALL_LETTERS]] = np.arange(NUM_LETTERS)
+
+
+def _code_points(text):
+    return np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+
+
+def words_to_indices(words, seq_len):
+    '''returns the character indices of every word, as word_to_indices does
+
+    Args:
+        words: list of strings, all of length seq_len
+
+    Return:
+        indices: int8 np.ndarray of shape (len(words), seq_len)
+    '''
+    lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+    wrong = np.flatnonzero(lengths != seq_len)
+    if len(wrong) > 0:
+        raise ValueError('Word %d has %d characters instead of %d'
+                         % (wrong[0], lengths[wrong[0]], seq_len))
+    codes = _code_points(''.join(words))
+    indices = np.full(len(codes), -1, dtype=np.int8)
+    ascii_codes = codes < len(_LETTER_INDICES)
+    indices[ascii_codes] = _LETTER_INDICES[codes[ascii_codes]]
+    return indices.reshape(len(words), seq_len)
+
+
+def letters_to_indices(letters):
+    '''returns the index of every letter, i.e. the position of the 1 in the
+    one-hot vectors returned by letter_to_vec
+
+    Args:
+        letters: list of single-character strings
+
+    Return:
+        indices: int8 np.ndarray of length len(letters)
+    '''
+    indices = words_to_indices(letters, 1).reshape(-1)
+    # letter_to_vec places the 1 of unknown letters in the last position
+    indices[indices == -1] = NUM_LETTERS - 1
+    return indices
+
+
 def word_to_indices(word):
     '''returns a list of character indices
 
@@ -115,16 +164,120 @@ def bag_of_words(line, vocab):
     return bag
 
 
+def lines_to_indices(lines, word2id, max_words=25):
+    '''converts every line into its word indices, as line_to_indices does
+
+    Return:
+        int32 np.ndarray of shape (len(lines), max_words)
+    '''
+    indices = np.empty((len(lines), max_words), dtype=np.int32)
+    for i, line in enumerate(lines):
+        indices[i] = line_to_indices(line, word2id, max_words)
+    return indices
+
+
+def lines_to_bag_indices(lines, vocab, max_words):
+    '''returns the vocabulary indices of the words of every line
+
+    Each row holds the indices of the words of a line found in vocab,
+    padded with -1 up to max_words: a fixed-width (ELL) layout of the
+    lines' bags of words, without CSR-style row pointers.
+
+    Args:
+        lines: list of strings representing phrases
+        vocab: dictionary with words as keys and indices as values
+        max_words: number of columns of the returned array
+
+    Return:
+        int32 np.ndarray of shape (len(lines), max_words)
+    '''
+    indices = np.full((len(lines), max_words), -1, dtype=np.int32)
+    for i, line in enumerate(lines):
+        words = [vocab[w] for w in split_line(line) if w in vocab]
+        if len(words) > max_words:
+            raise ValueError('Line with more than %d known words' % max_words)
+        indices[i, :len(words)] = words
+    return indices
+
+
+def bags_of_words(bag_indices, vocab_size):
+    '''returns the bags of words of the lines encoded by lines_to_bag_indices
+
+    Equivalent to calling bag_of_words on every line, without building any
+    Python list; the -1 padding of bag_indices is ignored.
+
+    Return:
+        float32 np.ndarray of shape (len(bag_indices), vocab_size)
+    '''
+    bag_indices = np.asarray(bag_indices)
+    rows = np.broadcast_to(np.arange(len(bag_indices))[:, None], bag_indices.shape)
+    valid = bag_indices >= 0
+    flat_indices = rows[valid].astype(np.int64) * vocab_size + bag_indices[valid]
+    bags = np.bincount(flat_indices, minlength=len(bag_indices) * vocab_size)
+    return bags.reshape(len(bag_indices), vocab_size).astype(np.float32)
+
+
+def _replace_atomically(path, write_fn):
+    '''writes a file through write_fn(file object) into a temporary file in
+    the same directory, then moves it to path, so readers never see a
+    partially written file
+    '''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as outf:
+            write_fn(outf)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _load_word_emb_cache(emb_path, vocab_path, src_mtime):
+    '''returns the cached (embedding matrix, word list), or None if they are
+    missing, older than the source or do not match each other
+    '''
+    if not all(os.path.isfile(p) and os.path.getmtime(p) >= src_mtime for p in (emb_path, vocab_path)):
+        return None
+    with open(vocab_path, 'r') as inf:
+        vocab = json.load(inf)
+    try:
+        word_emb_arr = np.load(emb_path, mmap_mode='r')
+    except ValueError:
+        return None
+    if word_emb_arr.ndim != 2 or word_emb_arr.shape[0] != len(vocab):
+        return None
+    return word_emb_arr, vocab
+
+
 def get_word_emb_arr(path):
-    with open(path, 'r') as inf:
-        embs = json.load(inf)
-    vocab = embs['vocab']
-    word_emb_arr = np.array(embs['emba'])
-    indd = {}
-    for i in range(len(vocab)):
-        indd[vocab[i]] = i
-    vocab = {w: i for i, w in enumerate(embs['vocab'])}
-    return word_emb_arr, indd, vocab
+    '''loads the word embeddings and vocabulary of the given embs.json
+
+    The first call converts the file into a .npy embedding matrix and a
+    _vocab.json word list next to it; these are used as long as they are
+    newer than the .json file and the matrix has a row per word, and the
+    matrix is memory-mapped.
+
+    Return:
+        word_emb_arr: float32 np.ndarray with the embedding of each word
+        indd: dictionary with words as keys and their indices as values
+        vocab: same as indd
+    '''
+    base_path = os.path.splitext(path)[0]
+    emb_path = base_path + '.npy'
+    vocab_path = base_path + '_vocab.json'
+
+    cached = _load_word_emb_cache(emb_path, vocab_path, os.path.getmtime(path))
+    if cached is None:
+        with open(path, 'r') as inf:
+            embs = json.load(inf)
+        word_emb_arr = np.array(embs['emba'], dtype=np.float32)
+        _replace_atomically(emb_path, lambda outf: np.save(outf, word_emb_arr))
+        _replace_atomically(vocab_path, lambda outf: outf.write(json.dumps(embs['vocab']).encode('utf-8')))
+        cached = np.load(emb_path, mmap_mode='r'), embs['vocab']
+
+    word_emb_arr, vocab = cached
+    indd = {w: i for i, w in enumerate(vocab)}
+    return word_emb_arr, indd, indd
 
 
 def val_to_vec(size, val):
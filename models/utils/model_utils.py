@@ -3,30 +3,100 @@ import numpy as np
 import os
 from collections import defaultdict
 
+from utils import cache_utils
 
-def batch_data(data, batch_size, seed):
+
+def batch_data(data, batch_size, seed, legacy_shuffle=False):
     '''
     data is a dict := {'x': [numpy array], 'y': [numpy array]} (on one client)
     returns x, y, which are both numpy array of length: batch_size
+
+    samples are shuffled with a single permutation drawn from a local
+    np.random.Generator seeded with seed, and gathered by fancy indexing;
+    lists are gathered element by element. If legacy_shuffle is set, the
+    permutation is drawn from the global RandomState seeded with seed
+    instead; this reproduces both the batches and the final global random
+    state of the former list-shuffling implementation
     '''
-    data_x = list(data['x'])
-    data_y = list(data['y'])
+    data_x = data['x']
+    data_y = data['y']
 
-    # randomly shuffle data
-    np.random.seed(seed)
-    rng_state = np.random.get_state()
-    np.random.shuffle(data_x)
-    np.random.set_state(rng_state)
-    np.random.shuffle(data_y)
+    if legacy_shuffle:
+        np.random.seed(seed)
+        perm = np.random.permutation(len(data_y))
+    else:
+        perm = np.random.default_rng(seed).permutation(len(data_y))
 
     # loop through mini-batches
-    for i in range(0, len(data_x), batch_size):
-        batched_x = data_x[i:i+batch_size]
-        batched_y = data_y[i:i+batch_size]
-        yield (batched_x, batched_y)
+    for i in range(0, len(perm), batch_size):
+        batch_indices = perm[i:i+batch_size]
+        yield (take(data_x, batch_indices), take(data_y, batch_indices))
+
+
+def take(values, indices):
+    '''gathers the elements at the given indices of a list or np.ndarray'''
+    if isinstance(values, np.ndarray):
+        return values[indices]
+    return [values[i] for i in indices]
+
+
+def read_dir(data_dir, use_cache=True, encode_fn=None, cache_name='raw', cache_key=None):
+    """Reads the users and data of the JSON files in data_dir.
+
+    The data of each user is encoded into NumPy arrays with encode_fn
+    (cache_utils.encode_user_data by default). If use_cache is set, the
+    encoded data are read from the binary cache of data_dir, which is built
+    on the first read (see utils/cache_utils.py); each user's data is then
+    a lazy cache_utils.UserData view. Data that encode_fn cannot encode are
+    returned as parsed from the JSON files.
+
+    Args:
+        data_dir: directory with the .json files.
+        use_cache: whether to use the binary cache.
+        encode_fn: function mapping the data of a user to a dict of
+            np.ndarray columns, or None if it cannot be encoded.
+        cache_name: name of the cache; caches built with different
+            encode_fn must have different names.
+        cache_key: JSON-serializable description of the other inputs of
+            encode_fn, e.g. the stat of a vocabulary file; the cache is
+            rebuilt when it changes.
+    """
+    if encode_fn is None:
+        encode_fn = cache_utils.encode_user_data
 
+    if use_cache:
+        index = cache_utils.load_cache(data_dir, cache_name, cache_key)
+        if index is None:
+            clients, groups, unions, data = _read_json_dir(data_dir)
+            index = cache_utils.build_cache(
+                data_dir, clients, groups, unions, data, cache_name, encode_fn, cache_key)
+            if not index['cacheable']:
+                return clients, groups, unions, data
+        if index['cacheable']:
+            return index['users'], index['groups'], index['unions'], _cached_user_data(index)
+        return _read_json_dir(data_dir)
 
-def read_dir(data_dir):
+    clients, groups, unions, data = _read_json_dir(data_dir)
+    encoded = cache_utils.encode_users(clients, data, encode_fn)
+    if encoded is not None:
+        data.update(zip(clients, encoded))
+    return clients, groups, unions, data
+
+
+def _cached_user_data(index):
+    """Returns a dict with user ids as keys and UserData views as values."""
+    data = defaultdict(lambda : None)
+    columns = index['columns']
+    arrays = {name: column['array'] for name, column in columns.items()}
+    for i, u in enumerate(index['users']):
+        data[u] = cache_utils.UserData(
+            arrays,
+            {name: column['offsets'][i] for name, column in columns.items()},
+            {name: column['lengths'][i] for name, column in columns.items()})
+    return data
+
+
+def _read_json_dir(data_dir):
     clients = []
     groups = []
     unions = []
@@ -53,13 +123,18 @@ def read_dir(data_dir):
     return clients, groups, unions, data
 
 
-def read_data(train_data_dir, test_data_dir):
+def read_data(train_data_dir, test_data_dir, use_cache=True, encode_fn=None, cache_name='raw', cache_key=None):
     '''parses data in given train and test data directories
 
     assumes:
     - the data in the input directories are .json files with 
         keys 'users' and 'user_data'
     - the set of train set users is the same as the set of test set users
+
+    each user's data is encoded with encode_fn (see read_dir); if use_cache
+    is set, the encoded data are memory-mapped from a binary cache, named
+    cache_name, built next to the .json files on the first run and rebuilt
+    when they or cache_key change
     
     Return:
         clients: list of client ids
@@ -67,8 +142,10 @@ def read_data(train_data_dir, test_data_dir):
         train_data: dictionary of train data
         test_data: dictionary of test data
     '''
-    train_clients, train_groups, train_unions, train_data = read_dir(train_data_dir)
-    test_clients, test_groups, test_unions, test_data = read_dir(test_data_dir)
+    train_clients, train_groups, train_unions, train_data = read_dir(
+        train_data_dir, use_cache, encode_fn, cache_name, cache_key)
+    test_clients, test_groups, test_unions, test_data = read_dir(
+        test_data_dir, use_cache, encode_fn, cache_name, cache_key)
 
     assert train_clients == test_clients
     assert train_groups == test_groups
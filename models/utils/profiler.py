@@ -0,0 +1,134 @@
+"""Wall-clock and CPU time profiling of the phases of the simulation.
+
+Every timed phase of a round (client selection, loading of the global
+weights, local training, aggregation, evaluation, metrics writing...)
+becomes one row of a timing csv, with the client it belongs to, if any, and
+the peak resident memory of the process so far.
+"""
+
+import contextlib
+import csv
+import os
+import resource
+import sys
+import time
+
+from baseline_constants import CLIENT_ID_KEY, NUM_ROUND_KEY
+
+
+TIMING_COLUMNS = [NUM_ROUND_KEY, CLIENT_ID_KEY, 'phase', 'wall_time', 'cpu_time', 'peak_rss_mb']
+
+# Phase holding the whole duration of every round.
+ROUND_PHASE = 'round'
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+class Profiler:
+    """Records the wall and CPU time of the phases of each round.
+
+    Phases are timed with the phase context manager; those timed within the
+    client context are attributed to that client. Phases should not be
+    nested, so that their times add up to the time of the round. CPU time is
+    the one of this process only, so it excludes the training carried out
+    by client workers.
+    """
+
+    def __init__(self, metrics_dir, metrics_name):
+        """
+        Args:
+            metrics_dir: String. Directory for the timing file. May not exist.
+            metrics_name: String. Filename for the timing file. May not exist.
+        """
+        self.metrics_dir = metrics_dir
+        self.path = os.path.join(metrics_dir, '{}.csv'.format(metrics_name))
+        self.round_number = 0
+        self.client_id = ''
+        self._file = None
+        self._writer = None
+        self._round_start = None
+        self._totals = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Times the enclosed block as the given phase."""
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self._record(name, time.perf_counter() - wall_start, time.process_time() - cpu_start)
+
+    @contextlib.contextmanager
+    def client(self, client_id):
+        """Attributes the phases timed in the enclosed block to the given client."""
+        self.client_id = client_id
+        try:
+            yield
+        finally:
+            self.client_id = ''
+
+    def start_round(self, round_number):
+        self.round_number = round_number
+        self._round_start = (time.perf_counter(), time.process_time())
+
+    def end_round(self):
+        """Records the duration of the round and flushes its rows."""
+        wall_start, cpu_start = self._round_start
+        self._record(ROUND_PHASE, time.perf_counter() - wall_start, time.process_time() - cpu_start)
+        self._file.flush()
+
+    def summary(self):
+        """Returns a table with the total and mean time of every phase."""
+        round_wall = self._totals.get(ROUND_PHASE, (0, 0., 0.))[1]
+        lines = ['%-16s %8s %12s %12s %12s %8s' % (
+            'phase', 'calls', 'wall total', 'wall mean', 'cpu total', '% round')]
+        for name, (calls, wall, cpu) in sorted(self._totals.items(), key=lambda t: -t[1][1]):
+            share = 100. * wall / round_wall if round_wall > 0 else float('nan')
+            lines.append('%-16s %8d %11.3fs %11.5fs %11.3fs %7.1f%%' % (name, calls, wall, wall / calls, cpu, share))
+        lines.append('peak RSS: %.1f MB' % peak_rss_mb())
+        return '\n'.join(lines)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _record(self, name, wall, cpu):
+        if self._file is None:
+            os.makedirs(self.metrics_dir, exist_ok=True)
+            self._file = open(self.path, 'w', newline='')
+            self._writer = csv.writer(self._file, lineterminator='\n')
+            self._writer.writerow(TIMING_COLUMNS)
+        self._writer.writerow([self.round_number, self.client_id, name, wall, cpu, peak_rss_mb()])
+
+        calls, total_wall, total_cpu = self._totals.get(name, (0, 0., 0.))
+        self._totals[name] = (calls + 1, total_wall + wall, total_cpu + cpu)
+
+
+class NullProfiler:
+    """Profiler that records nothing, used when profiling is disabled."""
+
+    _null_context = contextlib.nullcontext()
+
+    def phase(self, name):
+        return self._null_context
+
+    def client(self, client_id):
+        return self._null_context
+
+    def start_round(self, round_number):
+        pass
+
+    def end_round(self):
+        pass
+
+    def summary(self):
+        return ''
+
+    def close(self):
+        pass
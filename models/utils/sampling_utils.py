@@ -0,0 +1,107 @@
+"""Weighted sampling of clients without replacement.
+
+The clients' weights are stored once in a Fenwick tree of prefix sums, from
+which each round draws its clients in O(k log n): a client is found by
+descending the tree with a uniform draw over the remaining weight, and its
+weight is then removed so it cannot be drawn again in the round. The nodes
+touched are restored from a pristine copy of the tree afterwards, so every
+round starts from the same weights, without the rounding errors of adding
+them back.
+"""
+
+import numpy as np
+
+
+class ClientSampler:
+    """Draws weighted samples of clients without replacement.
+
+    By default, each round draws from its own np.random.Generator, seeded
+    from (seed, round), which leaves the global NumPy random state alone.
+    With legacy=True, the selection is the one of the published baselines:
+    np.random.seed(round) followed by np.random.choice over the clients
+    with replace=False and probabilities proportional to the weights, which
+    also reseeds the global random state every round.
+    """
+
+    def __init__(self, weights, seed=0, legacy=False):
+        """
+        Args:
+            weights: non-negative weight of every client, e.g. its number
+                of users.
+            seed: seed of the per-round generators.
+            legacy: whether to draw with np.random.choice as the
+                published baselines did.
+        """
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.seed = seed
+        self.legacy = legacy
+        self.num_clients = len(self.weights)
+        self.num_nonzero = int(np.count_nonzero(self.weights > 0))
+
+        total = self.weights.sum()
+        self.total_weight = total
+        # Same probabilities as [w / total for w in weights]
+        self.p = self.weights / total if total > 0 else self.weights
+
+        # tree[i] holds the sum of weights (i - lowbit(i), i], 1-based
+        cumsum = np.concatenate([[0.], np.cumsum(self.weights)])
+        index = np.arange(1, self.num_clients + 1)
+        self._tree = np.zeros(self.num_clients + 1)
+        self._tree[1:] = cumsum[index] - cumsum[index - (index & -index)]
+        self._work = self._tree.copy()
+        self._top_bit = 1 << (self.num_clients.bit_length() - 1) if self.num_clients else 0
+
+    def sample(self, my_round, num_clients):
+        """Returns the indices of num_clients clients drawn for my_round.
+
+        Indices are in the order they were drawn. num_clients is capped at
+        the number of clients.
+
+        Raises:
+            ValueError: if fewer clients than num_clients have a positive
+                weight.
+        """
+        num_clients = min(num_clients, self.num_clients)
+        if num_clients > self.num_nonzero:
+            raise ValueError('Fewer clients with a positive weight (%d) than requested (%d)'
+                             % (self.num_nonzero, num_clients))
+
+        if self.legacy:
+            np.random.seed(my_round)
+            return np.random.choice(self.num_clients, num_clients, replace=False, p=self.p)
+
+        rng = np.random.default_rng([self.seed, my_round])
+        draws = rng.random(num_clients)
+        tree, touched = self._work, []
+        remaining = self.total_weight
+        selected = np.empty(num_clients, dtype=np.int64)
+        chosen = set()
+        for j in range(num_clients):
+            i = self._find(draws[j] * remaining)
+            # Only reachable through rounding, at the edge of an interval
+            while self.weights[i] <= 0 or i in chosen:
+                i = (i - 1) % self.num_clients
+            selected[j] = i
+            chosen.add(i)
+            weight = self.weights[i]
+            remaining -= weight
+            k = i + 1
+            while k <= self.num_clients:
+                tree[k] -= weight
+                touched.append(k)
+                k += k & -k
+
+        tree[touched] = self._tree[touched]
+        return selected
+
+    def _find(self, target):
+        """Returns the client whose cumulative weight interval holds target."""
+        tree = self._work
+        pos, bit = 0, self._top_bit
+        while bit:
+            nxt = pos + bit
+            if nxt <= self.num_clients and tree[nxt] <= target:
+                pos = nxt
+                target -= tree[nxt]
+            bit >>= 1
+        return min(pos, self.num_clients - 1)